@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# A local stand-in for the OpenAI chat completions endpoint.
+#
+# Replies are deterministic: explanation requests get a fixed explanation, and
+# anything else gets a fenced command derived from the prompt. Streaming is
+# supported, and the server can add latency or fail every Nth request to
+# exercise chatbash's retry handling.
+#
+#   python3 benchmarks/fake_openai.py [--port 8000] [--latency-ms 0] [--fail-every 0]
+#   OPENAI_API_BASE=http://127.0.0.1:8000/v1 chatbash --batch prompts.txt
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EXPLANATION = "This command {command} does exactly what it says on the tin."
+
+
+def reply_for(messages):
+    prompt = messages[-1]["content"] if messages else ""
+    if "explanation of the following bash command:" in prompt:
+        command = prompt.split("bash command:", 1)[1].strip()
+        return EXPLANATION.format(command=command)
+    words = prompt.rsplit(":", 1)[-1].split()
+    return "```echo " + "-".join(words[:8]) + "```"
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            server.request_sizes.append(len(body))
+            count = server.request_count
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self.reply(body, count)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def reply(self, body, count):
+        server = self.server
+        time.sleep(server.latency)
+        if server.fail_every and count % server.fail_every == 0:
+            self.send_json(503, {"error": {"message": "overloaded, try again"}})
+            return
+
+        request = json.loads(body)
+        content = reply_for(request["messages"])
+        if request.get("stream"):
+            self.send_stream(content)
+        else:
+            self.send_json(
+                200,
+                {
+                    "id": f"chatcmpl-{count}",
+                    "object": "chat.completion",
+                    "model": request["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                },
+            )
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i in range(0, len(content), 4):
+            chunk = {
+                "choices": [{"index": 0, "delta": {"content": content[i : i + 4]}}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_server(port=0, latency_ms=0, fail_every=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency_ms / 1000
+    server.fail_every = fail_every
+    server.request_count = 0
+    server.request_sizes = []
+    # the most requests that were being answered at the same time
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    options = {"--port": 8000, "--latency-ms": 0, "--fail-every": 0}
+    args = sys.argv[1:]
+    for name in options:
+        if name in args:
+            options[name] = int(args[args.index(name) + 1])
+
+    server, url = start_fake_server(
+        options["--port"], options["--latency-ms"], options["--fail-every"]
+    )
+    print(f"fake OpenAI API listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Session benchmark for chatbash.
+#
+# Drives ChatHandler and main() against the deterministic fake completions API
+# in fake_openai.py, and fails if any of these regress past their budget:
+#
+#   turn overhead   median time of a feedback turn, minus the fake API's own
+#                   time to answer, i.e. what chatbash adds per turn
+#   request growth  size of the last request of a long session relative to one
+#                   halfway through; the token budget should keep this flat
+#   memory per turn Python memory allocated per turn over a long session
+#   main() session  a scripted interactive session through main(), run with
+#                   --profile, whose trace must cover the expected phases
+#   batch run       --batch in a fresh interpreter, with every worker starting
+#                   at once; every line must come back, in order, without errors
+#
+#   python3 benchmarks/session.py [turns]
+#
+# Budgets can be overridden with CHATBASH_TURN_BUDGET_MS,
+# CHATBASH_REQUEST_GROWTH_BUDGET, CHATBASH_TURN_MEMORY_BUDGET_KB,
+# CHATBASH_SESSION_BUDGET_MS and CHATBASH_BATCH_BUDGET_MS. Run
+# benchmarks/startup.py for startup time.
+import atexit
+import builtins
+import contextlib
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+from fake_openai import start_fake_server  # noqa: E402
+
+TURN_BUDGET_MS = float(os.environ.get("CHATBASH_TURN_BUDGET_MS", 15))
+REQUEST_GROWTH_BUDGET = float(os.environ.get("CHATBASH_REQUEST_GROWTH_BUDGET", 1.5))
+TURN_MEMORY_BUDGET_KB = float(os.environ.get("CHATBASH_TURN_MEMORY_BUDGET_KB", 16))
+SESSION_BUDGET_MS = float(os.environ.get("CHATBASH_SESSION_BUDGET_MS", 1500))
+BATCH_BUDGET_MS = float(os.environ.get("CHATBASH_BATCH_BUDGET_MS", 3000))
+
+server, url = start_fake_server()
+workdir = tempfile.mkdtemp(prefix="chatbash-bench-")
+os.environ.update(
+    OPENAI_API_BASE=url,
+    OPENAI_API_KEY="sk-benchmark",
+    CHATBASH_SOCKET=os.path.join(workdir, "no-daemon.sock"),
+    CHATBASH_CACHE=os.path.join(workdir, "responses.sqlite"),
+    CHATBASH_MAN_INDEX=os.path.join(workdir, "man.sqlite"),
+    CHATBASH_PROFILE=os.path.join(workdir, "profile.json"),
+    CHATBASH_HISTORY=os.path.join(workdir, "history.sqlite"),
+)
+
+import chatbash  # noqa: E402
+from rich.console import Console  # noqa: E402
+
+chatbash.console = Console(file=io.StringIO())
+
+
+def report(name, value, unit, budget):
+    status = "ok" if value <= budget else "OVER BUDGET"
+    print(f"{name:<16} {value:9.2f} {unit:<3} budget {budget:g} {unit}  {status}")
+    return value <= budget
+
+
+def time_api_round_trip(chat, runs):
+    # what the fake API and the HTTP client cost on their own
+    conversation = chatbash.command_request("list files")
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        chatbash.request_completion(conversation, chat.api_key)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def feedback_turn(chat, turn):
+    chat.update_conversation({"role": "user", "content": f"feedback number {turn}"})
+    command = chat.refine_prompt("")
+    chat.request_explanation(command)
+
+
+def bench_turns(turns):
+    # a small token budget, so the session hits it early on
+    chat = chatbash.ChatHandler(use_cache=False, use_daemon=False, token_budget=1000)
+    chat.conversation.extend(chatbash.command_request("find files larger than 1G"))
+    chat.generate_command(chat.conversation)
+    api_time = time_api_round_trip(chat, 20)
+
+    # each turn makes two requests: the refined command and its explanation
+    timings = []
+    for turn in range(20):
+        start = time.perf_counter()
+        feedback_turn(chat, turn)
+        timings.append((time.perf_counter() - start) / 2)
+    overhead_ms = (statistics.median(timings) - api_time) * 1000
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for turn in range(turns):
+        feedback_turn(chat, turn)
+        if turn == turns // 2:
+            halfway_request = max(server.request_sizes[-2:])
+    growth_kb = (tracemalloc.get_traced_memory()[0] - before) / 1024 / turns
+    tracemalloc.stop()
+    request_growth = max(server.request_sizes[-2:]) / halfway_request
+
+    return [
+        report("turn overhead", overhead_ms, "ms", TURN_BUDGET_MS),
+        report("request growth", request_growth, "x", REQUEST_GROWTH_BUDGET),
+        report("memory per turn", growth_kb, "KB", TURN_MEMORY_BUDGET_KB),
+    ]
+
+
+def bench_main():
+    # x, f, p, t, then q: every option that doesn't run a command
+    answers = iter(["x", "f", "use human readable sizes", "p", "t", "q"])
+    input = builtins.input
+    argv = sys.argv
+    builtins.input = lambda prompt="": next(answers)
+    sys.argv = ["chatbash", "--profile", "--no-cache", "show disk usage"]
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            with contextlib.redirect_stderr(io.StringIO()):
+                chatbash.main()
+    except SystemExit as e:
+        exit_code = e.code
+    finally:
+        builtins.input = input
+        sys.argv = argv
+    session_ms = (time.perf_counter() - start) * 1000
+
+    # --profile writes its trace at exit; write it now to inspect it
+    atexit.unregister(chatbash.profiler.write)
+    chatbash.profiler.write()
+    with open(os.environ["CHATBASH_PROFILE"]) as trace_file:
+        trace = json.load(trace_file)
+    expected = {"chat_gpt", "extract_code_block", "print_conversation"}
+    missing = expected - set(trace["totals"])
+    if exit_code != 0 or missing:
+        print(f"main() session  exit code {exit_code}, missing phases {missing}")
+        return [False]
+    return [report("main() session", session_ms, "ms", SESSION_BUDGET_MS)]
+
+
+def bench_batch(lines=32):
+    # A fresh interpreter, so the workers race to import openai for the
+    # first time, and no rate limit, so they all start at once.
+    prompts = [f"list the files in directory {i}" for i in range(lines)]
+    env = dict(os.environ, CHATBASH_BATCH_WORKERS="8", CHATBASH_BATCH_RPM="100000")
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, chatbash.__file__, "--no-cache", "--batch"],
+        input="\n".join(prompts),
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    batch_ms = (time.perf_counter() - start) * 1000
+    results = [json.loads(line) for line in process.stdout.splitlines()]
+    inputs = [item.get("input") for item in results]
+    errors = [item["error"] for item in results if "error" in item]
+    if process.returncode != 0 or inputs != prompts or errors:
+        print(f"batch run       exit code {process.returncode}, errors {errors[:1]}")
+        print(process.stderr[-2000:])
+        return [False]
+    return [report("batch run", batch_ms, "ms", BATCH_BUDGET_MS)]
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    results = bench_turns(turns) + bench_main() + bench_batch()
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
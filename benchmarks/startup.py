@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Cold-start benchmark for chatbash.
+#
+# Launches chatbash in a fresh interpreter for both the quick explain (-x) and
+# the interactive mode, and fails if the median startup time exceeds the
+# budget. Budgets apply to the time spent on top of starting a bare
+# interpreter, so they don't depend on how slow the machine's Python itself is
+# to start.
+#
+# The -x run explains a real command from a small man page index built in a
+# temporary directory, so it covers the whole offline path. The interactive
+# run quits at the first prompt, right before the first API call.
+#
+#   python3 benchmarks/startup.py [runs]
+#
+# Budgets (in milliseconds) can be overridden with CHATBASH_X_BUDGET_MS and
+# CHATBASH_INTERACTIVE_BUDGET_MS.
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CHATBASH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chatbash.py")
+
+X_BUDGET_MS = float(os.environ.get("CHATBASH_X_BUDGET_MS", 200))
+INTERACTIVE_BUDGET_MS = float(os.environ.get("CHATBASH_INTERACTIVE_BUDGET_MS", 250))
+
+LS_PAGE = r""".TH LS 1
+.SH NAME
+ls \- list directory contents
+.SH OPTIONS
+.TP
+\fB\-a\fR, \fB\-\-all\fR
+do not ignore entries starting with .
+.TP
+\fB\-l\fR
+use a long listing format
+"""
+
+
+def benchmark_environment(workdir):
+    # Nothing in the runs may reach a daemon, the user's own caches or the
+    # network: an unexpected request fails fast against a closed port.
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="sk-benchmark",
+        OPENAI_API_BASE="http://127.0.0.1:9/v1",
+        CHATBASH_MAX_RETRIES="0",
+        CHATBASH_SOCKET=os.path.join(workdir, "no-daemon.sock"),
+        CHATBASH_CACHE=os.path.join(workdir, "responses.sqlite"),
+        CHATBASH_HISTORY=os.path.join(workdir, "history.sqlite"),
+        CHATBASH_MAN_INDEX=os.path.join(workdir, "man.sqlite"),
+        MANPATH=os.path.join(workdir, "man"),
+    )
+    os.makedirs(os.path.join(workdir, "man", "man1"))
+    with open(os.path.join(workdir, "man", "man1", "ls.1"), "w") as page:
+        page.write(LS_PAGE)
+    subprocess.run(
+        [sys.executable, CHATBASH, "--build-man-index"],
+        env=env,
+        capture_output=True,
+        check=True,
+    )
+    return env
+
+
+def time_launch(argv, stdin_text="", env=None):
+    start = time.perf_counter()
+    result = subprocess.run(
+        argv,
+        input=stdin_text,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return (time.perf_counter() - start) * 1000, result
+
+
+def bench(name, args, stdin_text, budget_ms, runs, baseline, env):
+    argv = [sys.executable, CHATBASH, *args]
+    timings = []
+    for _ in range(runs):
+        elapsed, result = time_launch(argv, stdin_text, env)
+        if result.returncode != 0:
+            print(f"{name:<12} failed with exit code {result.returncode}")
+            print(result.stdout + result.stderr)
+            return False
+        timings.append(elapsed)
+    overhead = statistics.median(timings) - baseline
+    status = "ok" if overhead <= budget_ms else "OVER BUDGET"
+    print(
+        f"{name:<12} median +{overhead:6.1f} ms  min +{min(timings) - baseline:6.1f} ms  "
+        f"budget {budget_ms:.0f} ms  {status}"
+    )
+    return overhead <= budget_ms
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    env = benchmark_environment(tempfile.mkdtemp(prefix="chatbash-startup-"))
+    baseline = statistics.median(
+        time_launch([sys.executable, "-c", "pass"])[0] for _ in range(runs)
+    )
+    print(f"{'python':<12} median {baseline:7.1f} ms")
+    results = [
+        bench("-x", ["-x", "ls -la"], "", X_BUDGET_MS, runs, baseline, env),
+        bench("interactive", [], "q\n", INTERACTIVE_BUDGET_MS, runs, baseline, env),
+    ]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,1504 @@
 #!/usr/bin/env python3
 # WORKERS OF THE WORLD UNITE ✊
-from typing import Dict
+from typing import Dict, Iterator
 import re
 import readline
 import os
 import sys
+import socket
 import subprocess
-import venv
+import json
+import functools
+import random
+import threading
+import time
+import atexit
+import contextlib
 
+STARTED = time.perf_counter()
 
-def setup_virtual_environment():
-    venv_path = "venv"
-    if not os.path.exists(venv_path):
-        venv.create(venv_path, with_pip=True)
+MODEL = "gpt-4"
+TEMPERATURE = 0.1
 
-    if sys.platform == "win32":
-        activate_script = os.path.join(venv_path, "Scripts")
-    else:
-        activate_script = os.path.join(venv_path, "bin")
+# The socket lives in a directory only this user can enter, so nobody else
+# can put a socket of their own in its place
+SOCKET_PATH = os.environ.get(
+    "CHATBASH_SOCKET",
+    os.path.join(
+        (
+            os.path.join(os.environ["XDG_RUNTIME_DIR"], "chatbash")
+            if "XDG_RUNTIME_DIR" in os.environ
+            else f"/tmp/chatbash-{os.getuid()}"
+        ),
+        "daemon.sock",
+    ),
+)
+DAEMON_WORKERS = int(os.environ.get("CHATBASH_DAEMON_WORKERS", 4))
+DAEMON_CONNECT_TIMEOUT = 1
+DAEMON_TIMEOUT = float(os.environ.get("CHATBASH_DAEMON_TIMEOUT", 120))
+
+
+PROFILE_PATH = os.environ.get(
+    "CHATBASH_PROFILE",
+    os.path.join(
+        os.environ.get("TMPDIR", "/tmp"), f"chatbash-profile-{os.getpid()}.json"
+    ),
+)
 
-    os.environ["PATH"] = f"{activate_script}{os.pathsep}{os.environ['PATH']}"
 
+def interpreter_startup_ms():
+    # Time from process start until this module started running. Only
+    # available on Linux, and only as precise as the kernel's clock ticks.
     try:
-        global Text, Console, Panel, box
-        from rich import box
-        from rich.console import Console
-        from rich.panel import Panel
-        from rich.text import Text
+        with open("/proc/self/stat") as stat:
+            start_ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            seconds_since_boot = float(uptime.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    process_age = seconds_since_boot - start_ticks / os.sysconf("SC_CLK_TCK")
+    return round((process_age - (time.perf_counter() - STARTED)) * 1000, 1)
+
+
+class Profiler:
+    def __init__(self, path: str = PROFILE_PATH) -> None:
+        self.path = path
+        self.phases = []
+
+    def record(self, name: str, start: float, end: float, **info) -> None:
+        self.phases.append(
+            {
+                "name": name,
+                "thread": threading.current_thread().name,
+                "start_ms": round((start - STARTED) * 1000, 3),
+                "duration_ms": round((end - start) * 1000, 3),
+                **info,
+            }
+        )
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **info):
+        # Callers can add to the yielded dict, e.g. the size of a response
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(name, start, time.perf_counter(), **info)
+
+    def write(self) -> None:
+        totals = {}
+        for phase in self.phases:
+            total = totals.setdefault(phase["name"], {"count": 0, "duration_ms": 0})
+            total["count"] += 1
+            total["duration_ms"] = round(total["duration_ms"] + phase["duration_ms"], 3)
+        trace = {
+            "argv": sys.argv,
+            "interpreter_startup_ms": interpreter_startup_ms(),
+            "session_ms": round((time.perf_counter() - STARTED) * 1000, 3),
+            "phases": self.phases,
+            "totals": totals,
+        }
+        with open(self.path, "w") as trace_file:
+            json.dump(trace, trace_file, indent=2)
+        print(f"Profile written to {self.path}", file=sys.stderr)
+
+
+profiler = None
+
+
+def profiled(name: str, **info):
+    if profiler is None:
+        return contextlib.nullcontext(info)
+    return profiler.phase(name, **info)
+
+
+def exit_missing_dependency(error: ImportError):
+    sys.exit(
+        f"Error: the {error.name.split('.')[0]} module is not installed. "
+        "Run 'chatbash --setup' to install it."
+    )
+
+
+def import_openai():
+    # Always go through the import statement: the key is in sys.modules
+    # before the module has finished running, and the import lock is what
+    # makes a second thread wait for it.
+    try:
+        if "openai" not in sys.modules:
+            with profiled("import openai"):
+                import openai
+        else:
+            import openai
+    except ImportError as e:
+        exit_missing_dependency(e)
+    return openai
+
+
+def install_dependencies():
+    # pip installs into the python3 running this, the same python3 that the
+    # installed script's shebang runs
+    try:
+        import openai  # noqa: F401
+        import rich  # noqa: F401
     except ImportError:
         subprocess.check_call(
             [sys.executable, "-m", "pip", "install", "rich", "openai"]
         )
-        from rich import box
-        from rich.console import Console
-        from rich.panel import Panel
-        from rich.text import Text
 
 
-setup_virtual_environment()
-import openai  # noqa: E402
-from rich.table import Table  # noqa: E402
+class LazyConsole:
+    # rich is only imported the first time something is printed
+    def __getattr__(self, name):
+        global console
+        with profiled("import rich"):
+            try:
+                from rich.console import Console
+            except ImportError as e:
+                exit_missing_dependency(e)
 
-console = Console()
+            console = Console()
+        return getattr(console, name)
 
 
-class ChatHandler:
+console = LazyConsole()
+
+
+class ChatError(Exception):
+    def __init__(self, message, transient: bool = False) -> None:
+        super().__init__(message)
+        self.transient = transient
+
+
+def is_transient(error: Exception) -> bool:
+    # Errors worth retrying: rate limits, timeouts, dropped connections and
+    # server side failures.
+    openai = import_openai()
+
+    if isinstance(
+        error,
+        (
+            openai.error.RateLimitError,
+            openai.error.Timeout,
+            openai.error.TryAgain,
+            openai.error.APIConnectionError,
+            openai.error.ServiceUnavailableError,
+        ),
+    ):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+def request_completion(conversation, api_key):
+    openai = import_openai()
+
+    response = openai.ChatCompletion.create(
+        model=MODEL, messages=conversation, temperature=TEMPERATURE, api_key=api_key
+    )
+    return response["choices"][0]["message"]["content"]
+
+
+def request_completion_stream(conversation, api_key) -> Iterator[str]:
+    openai = import_openai()
+
+    response = openai.ChatCompletion.create(
+        model=MODEL,
+        messages=conversation,
+        temperature=TEMPERATURE,
+        api_key=api_key,
+        stream=True,
+    )
+    for chunk in response:
+        delta = chunk["choices"][0]["delta"].get("content")
+        if delta:
+            yield delta
+
+
+def is_private_directory(path: str) -> bool:
+    import stat
+
+    # lstat, so a symlink to someone else's directory doesn't pass
+    info = os.lstat(path)
+    return (
+        stat.S_ISDIR(info.st_mode)
+        and info.st_uid == os.getuid()
+        and not info.st_mode & 0o077
+    )
+
+
+def peer_uid(client: socket.socket):
+    # The uid of the process on the other end, where the platform says
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    import struct
+
+    credentials = client.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+    )
+    return struct.unpack("3i", credentials)[1]
+
+
+def connect_to_daemon():
+    # Returns None when no daemon is listening, or when the one listening
+    # might not be ours, so the caller can fall back to making the request
+    # in-process. The API key is only ever sent to a daemon run by this user.
+    try:
+        if not is_private_directory(os.path.dirname(SOCKET_PATH)):
+            print(
+                f"Warning: not using the daemon, {os.path.dirname(SOCKET_PATH)} "
+                "is not a private directory of yours",
+                file=sys.stderr,
+            )
+            return None
+    except FileNotFoundError:
+        return None
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_CONNECT_TIMEOUT)
+    try:
+        client.connect(SOCKET_PATH)
+    except OSError:
+        client.close()
+        return None
+    if peer_uid(client) not in (None, os.getuid()):
+        print(
+            f"Warning: not using the daemon, {SOCKET_PATH} belongs to another user",
+            file=sys.stderr,
+        )
+        client.close()
+        return None
+    client.settimeout(DAEMON_TIMEOUT)
+    return client
+
+
+def request_completion_from_daemon(conversation, api_key):
+    client = connect_to_daemon()
+    if client is None:
+        return None
+
+    # A daemon that stopped answering is treated like no daemon at all
+    try:
+        with client, client.makefile("rw", encoding="utf-8") as stream:
+            stream.write(json.dumps({"messages": conversation, "api_key": api_key}))
+            stream.write("\n")
+            stream.flush()
+            reply = json.loads(stream.readline())
+    except socket.timeout:
+        return None
+
+    if "error" in reply:
+        raise ChatError(reply["error"], reply.get("transient", False))
+    return reply["content"]
+
+
+def request_completion_stream_from_daemon(conversation, api_key):
+    client = connect_to_daemon()
+    if client is None:
+        return None
+
+    stream = client.makefile("rw", encoding="utf-8")
+    try:
+        request = {"messages": conversation, "api_key": api_key, "stream": True}
+        stream.write(json.dumps(request))
+        stream.write("\n")
+        stream.flush()
+        # Wait for the first line here, so a daemon that stopped answering
+        # falls back to in-process before anything has been shown
+        first_line = stream.readline()
+    except socket.timeout:
+        stream.close()
+        client.close()
+        return None
+
+    def deltas():
+        with client, stream:
+            line = first_line
+            while line:
+                reply = json.loads(line)
+                if "error" in reply:
+                    raise ChatError(reply["error"], reply.get("transient", False))
+                if reply.get("done"):
+                    return
+                yield reply["delta"]
+                try:
+                    line = stream.readline()
+                except socket.timeout:
+                    raise ChatError("The daemon stopped responding", transient=True)
+
+    return deltas()
+
+
+def run_daemon():
+    import socketserver
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Importing openai up front keeps the module loaded, and serving requests
+    # on a fixed pool of threads lets each of them reuse its keep-alive HTTP
+    # session (openai keeps one per thread). A pool rather than one thread,
+    # so speculative requests don't queue ahead of the one the user is
+    # waiting for.
+    import_openai()
+    workers = ThreadPoolExecutor(max_workers=DAEMON_WORKERS)
+
+    class CompletionServer(socketserver.UnixStreamServer):
+        def process_request(self, request, client_address):
+            workers.submit(self.process_request_thread, request, client_address)
+
+        def process_request_thread(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    class CompletionHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # Clients hang up early as a matter of course: --stream stops
+            # reading once the command is complete, and a client that timed
+            # out has moved on.
+            try:
+                for line in self.rfile:
+                    self.handle_request(json.loads(line))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def handle_request(self, request):
+            if request.get("stream"):
+                self.handle_stream(request)
+                return
+            try:
+                content = request_completion(request["messages"], request["api_key"])
+                reply = {"content": content}
+            except Exception as e:
+                reply = {"error": str(e), "transient": is_transient(e)}
+            self.send(reply)
+
+        def handle_stream(self, request):
+            try:
+                for delta in request_completion_stream(
+                    request["messages"], request["api_key"]
+                ):
+                    self.send({"delta": delta})
+                self.send({"done": True})
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as e:
+                self.send({"error": str(e), "transient": is_transient(e)})
+
+        def send(self, reply):
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+    directory = os.path.dirname(SOCKET_PATH)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not is_private_directory(directory):
+        sys.exit(
+            f"Error: {directory} must be a directory only you can access. "
+            "Remove it, or set CHATBASH_SOCKET to a path in one."
+        )
+
+    # A socket nobody is listening on is left over from a daemon that died,
+    # but one that still answers belongs to a daemon that is running
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(DAEMON_CONNECT_TIMEOUT)
+    try:
+        probe.connect(SOCKET_PATH)
+        listening = True
+    except (FileNotFoundError, ConnectionRefusedError):
+        listening = False
+    except socket.timeout:
+        # too busy to accept, but there all the same
+        listening = True
+    finally:
+        probe.close()
+    if listening:
+        sys.exit(f"Error: a chatbash daemon is already listening on {SOCKET_PATH}")
+    if os.path.lexists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+
+    old_umask = os.umask(0o077)
+    try:
+        server = CompletionServer(SOCKET_PATH, CompletionHandler)
+    finally:
+        os.umask(old_umask)
+
+    print(f"chatbash daemon listening on {SOCKET_PATH}")
+    try:
+        with server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        workers.shutdown(wait=False, cancel_futures=True)
+        os.remove(SOCKET_PATH)
+
+
+CACHE_PATH = os.environ.get(
+    "CHATBASH_CACHE",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "chatbash",
+        "responses.sqlite",
+    ),
+)
+CACHE_MAX_BYTES = int(os.environ.get("CHATBASH_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+CACHE_TTL = int(os.environ.get("CHATBASH_CACHE_TTL", 7 * 24 * 60 * 60))
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        path: str = CACHE_PATH,
+        max_bytes: int = CACHE_MAX_BYTES,
+        ttl: int = CACHE_TTL,
+    ) -> None:
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Streamed replies are cached from the thread that finishes reading
+        # them, and batch mode shares one cache between its workers.
+        self.db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, content BLOB, size INTEGER, "
+                "created REAL, last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+
+    def make_key(self, conversation) -> str:
+        import hashlib
+
+        # Only the fields the API sees matter, and whitespace at the edges of
+        # a message doesn't change the answer.
+        messages = [
+            {"role": m["role"], "content": m["content"].strip()} for m in conversation
+        ]
+        normalized = json.dumps(
+            {"model": MODEL, "temperature": TEMPERATURE, "messages": messages},
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def get(self, conversation, count: bool = True):
+        import zlib
+
+        key = self.make_key(conversation)
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT content FROM responses WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                if count:
+                    self.count("misses")
+                return None
+            self.db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+            )
+            if count:
+                self.count("hits")
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, conversation, content: str) -> None:
+        import zlib
+
+        key = self.make_key(conversation)
+        blob = zlib.compress(content.encode("utf-8"))
+        # a reply bigger than the whole cache would evict everything else
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now),
+            )
+            self.evict(now)
+
+    def evict(self, now: float) -> None:
+        self.db.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        # Drop the least recently used entries once the total size is over budget
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM (SELECT key, SUM(size) OVER "
+            "(ORDER BY last_used DESC) AS running FROM responses) "
+            "WHERE running > ?)",
+            (self.max_bytes,),
+        )
+
+    def count(self, name: str) -> None:
+        self.db.execute(
+            "INSERT INTO stats VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def stats(self) -> Dict:
+        stats = dict(self.db.execute("SELECT name, value FROM stats"))
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return {
+            "hits": stats.get("hits", 0),
+            "misses": stats.get("misses", 0),
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+MAN_INDEX_PATH = os.environ.get(
+    "CHATBASH_MAN_INDEX", os.path.join(os.path.dirname(CACHE_PATH), "man.sqlite")
+)
+MAN_PATH = os.environ.get(
+    "MANPATH", "/usr/local/share/man:/usr/share/man:/usr/local/man"
+)
+MAN_SECTIONS = ("1", "8")
+
+ROFF_ESCAPE_PATTERN = re.compile(
+    r"\\(f\[[^\]]*\]|f\(..|f.|\(..|\*\[[^\]]*\]|\*\(..|\*.|s[+-]?\d+|.)"
+)
+ROFF_ESCAPES = {"-": "-", "e": "\\", "\\": "\\", " ": " ", "~": " ", "(aq": "'"}
+ROFF_FONT_MACROS = {"B", "I", "SM", "SB", "BR", "RB", "BI", "IB", "IR", "RI"}
+# macros that start a new paragraph, and so end the description of an option
+ROFF_PARAGRAPH_MACROS = {"SH", "SS", "TP", "IP", "PP", "P", "LP", "HP"}
+FLAG_PATTERN = re.compile(r"(?<![\w-])(--?[A-Za-z0-9?][\w-]*)")
+
+
+def clean_roff(line: str) -> str:
+    return ROFF_ESCAPE_PATTERN.sub(
+        lambda match: ROFF_ESCAPES.get(match.group(1), ""), line
+    )
+
+
+def roff_arguments(arguments: str):
+    return [argument.strip('"') for argument in re.findall(r'"[^"]*"|\S+', arguments)]
+
+
+def parse_man_page(text: str):
+    # Pulls the one-line summary out of the NAME section, and the options out
+    # of tagged paragraphs (.TP, .IP, and the .PP/.RS layout DocBook emits)
+    # whose tag starts with a dash.
+    section = None
+    name_lines = []
+    options = {}
+    flags = []
+    description = []
+    expect_tag = False
+
+    def finish_option():
+        if flags and description:
+            text = " ".join(" ".join(description).split())
+            text = re.split(r"(?<=\.)\s", text, 1)[0][:200]
+            for flag in flags:
+                options.setdefault(flag, text)
+        flags.clear()
+        description.clear()
+
+    for line in text.splitlines():
+        if line.startswith((".", "'")):
+            macro, _, arguments = line[1:].strip().partition(" ")
+            if macro in ROFF_FONT_MACROS:
+                separator = " " if len(macro) == 1 or macro[0] == "S" else ""
+                line = separator.join(roff_arguments(clean_roff(arguments)))
+            elif macro in ROFF_PARAGRAPH_MACROS:
+                finish_option()
+                if macro == "SH":
+                    section = " ".join(roff_arguments(arguments)).upper()
+                expect_tag = macro in ("TP", "PP", "P", "LP")
+                if macro == "IP" and arguments:
+                    tag = clean_roff(roff_arguments(arguments)[0])
+                    if tag.startswith("-"):
+                        flags.extend(FLAG_PATTERN.findall(tag))
+                continue
+            elif macro == "TQ":
+                expect_tag = True
+                continue
+            else:
+                continue
+        else:
+            line = clean_roff(line)
+
+        if section == "NAME":
+            name_lines.append(line)
+        elif expect_tag:
+            expect_tag = False
+            if line.lstrip().startswith("-"):
+                flags.extend(FLAG_PATTERN.findall(line))
+        elif flags:
+            description.append(line)
+
+    finish_option()
+    name = " ".join(" ".join(name_lines).split())
+    summary = name.split(" - ", 1)[1] if " - " in name else name
+    return summary, options
+
+
+class ManIndex:
+    def __init__(self, path: str = MAN_INDEX_PATH) -> None:
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS pages "
+                "(name TEXT PRIMARY KEY, summary TEXT) WITHOUT ROWID"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS options (program TEXT, flag TEXT, "
+                "description TEXT, PRIMARY KEY (program, flag)) WITHOUT ROWID"
+            )
+
+    def build(self, man_path: str = MAN_PATH) -> int:
+        import gzip
+
+        pages = 0
+        with self.db:
+            self.db.execute("DELETE FROM pages")
+            self.db.execute("DELETE FROM options")
+            for base in man_path.split(":"):
+                for section in MAN_SECTIONS:
+                    directory = os.path.join(base, f"man{section}")
+                    if not os.path.isdir(directory):
+                        continue
+                    for filename in sorted(os.listdir(directory)):
+                        path = os.path.join(directory, filename)
+                        opener = gzip.open if filename.endswith(".gz") else open
+                        try:
+                            with opener(path, "rt", errors="replace") as page:
+                                text = page.read()
+                        except OSError:
+                            continue
+                        # skip pages that only redirect to another page
+                        if text.startswith(".so "):
+                            continue
+                        name = filename.removesuffix(".gz").rsplit(".", 1)[0]
+                        if self.add_page(name, *parse_man_page(text)):
+                            pages += 1
+        return pages
+
+    def add_page(self, name: str, summary: str, options: Dict) -> bool:
+        # The first page found for a name wins, like it does for man(1)
+        added = self.db.execute(
+            "INSERT OR IGNORE INTO pages VALUES (?, ?)", (name, summary)
+        ).rowcount
+        if added:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO options VALUES (?, ?, ?)",
+                [(name, flag, text) for flag, text in options.items()],
+            )
+        return bool(added)
+
+    def summary(self, name: str):
+        row = self.db.execute(
+            "SELECT summary FROM pages WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def option(self, program: str, flag: str):
+        row = self.db.execute(
+            "SELECT description FROM options WHERE program = ? AND flag = ?",
+            (program, flag),
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def describe_flag(self, program: str, word: str):
+        # Returns (flag, description) pairs, or None if any part is unknown.
+        # Bundled short flags like -xzvf are looked up one letter at a time.
+        flag = word.split("=", 1)[0]
+        description = self.option(program, flag)
+        if description is not None:
+            return [(flag, description)]
+        if flag.startswith("--") or len(flag) <= 2:
+            return None
+        described = []
+        for letter in flag[1:]:
+            description = self.option(program, f"-{letter}")
+            if description is None:
+                return None
+            described.append((f"-{letter}", description))
+        return described
+
+
+COMMAND_SEPARATORS = {"|", "||", "&", "&&", ";", ";;", "(", ")", "|&"}
+REDIRECTIONS = {">", ">>", "<", "<<", "<<<", ">&", "&>", "<&"}
+COMMAND_WRAPPERS = {"sudo", "time", "nohup", "exec", "command", "builtin"}
+# shlex returns the same ";" for find's \; as for the operator, so escaped
+# and quoted ones are swapped for a stand-in before splitting
+QUOTED_SEMICOLON_PATTERN = re.compile(r"\\;|';'|\";\"")
+QUOTED_SEMICOLON = "\ue000"
+# the file descriptor in 2>&1 or 2>/dev/null
+REDIRECTED_FD_PATTERN = re.compile(r"(?<!\S)\d+(?=[<>])")
+
+
+def split_command_line(command: str):
+    # Splits a command line into its simple commands, dropping redirections,
+    # so pipelines and lists can be explained one program at a time.
+    # Wrappers like sudo come out as commands of their own, with their
+    # flags, followed by the command they run.
+    import shlex
+
+    command = QUOTED_SEMICOLON_PATTERN.sub(QUOTED_SEMICOLON, command)
+    command = REDIRECTED_FD_PATTERN.sub("", command)
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        words = list(lexer)
+    except ValueError:
+        words = command.split()
+
+    segment = []
+    skip_next = False
+    for word in words:
+        if skip_next:
+            skip_next = False
+        elif word in COMMAND_SEPARATORS:
+            if segment:
+                yield segment
+            segment = []
+        elif word in REDIRECTIONS:
+            skip_next = True
+        else:
+            if segment and segment[0] in COMMAND_WRAPPERS and word[0] != "-":
+                yield segment
+                segment = []
+            if not segment and ("=" in word and not word.startswith("-")):
+                continue
+            segment.append(word.replace(QUOTED_SEMICOLON, ";"))
+    if segment:
+        yield segment
+
+
+def explain_offline(command: str, index_path: str = MAN_INDEX_PATH) -> bool:
+    # Prints what the man page index knows about each program and flag in
+    # the command, and returns whether that covered all of them.
+    if not os.path.exists(index_path):
+        return False
+    index = ManIndex(index_path)
+    covered = True
+    for words in split_command_line(command):
+        page = os.path.basename(words[0])
+        summary = index.summary(page)
+        if summary is None:
+            console.print(f"{page}: not in the man pages", style="yellow", markup=False)
+            covered = False
+            continue
+
+        # "git commit" is documented in git-commit(1)
+        arguments = words[1:]
+        while arguments and not arguments[0].startswith("-"):
+            subcommand_summary = index.summary(f"{page}-{arguments[0]}")
+            if subcommand_summary is None:
+                break
+            page, summary = f"{page}-{arguments[0]}", subcommand_summary
+            arguments = arguments[1:]
+
+        console.print(f"{page}: {summary}", style="bold green", markup=False)
+        for word in arguments:
+            if not word.startswith("-") or word in ("-", "--"):
+                continue
+            described = index.describe_flag(page, word)
+            if described is None:
+                console.print(
+                    f"  {word}  not in the man page", style="yellow", markup=False
+                )
+                covered = False
+                continue
+            for flag, description in described:
+                console.print(
+                    f"  {flag}  {description}",
+                    style="green",
+                    highlight=False,
+                    markup=False,
+                )
+    return covered
+
+
+HISTORY_PATH = os.environ.get(
+    "CHATBASH_HISTORY",
+    os.path.join(
+        os.environ.get("XDG_DATA_HOME", os.path.expanduser("~/.local/share")),
+        "chatbash",
+        "history.sqlite",
+    ),
+)
+HISTORY_MATCH_THRESHOLD = 0.5
+HISTORY_SKETCH_SIZE = 64
+HISTORY_BAND_ROWS = 4
+HISTORY_BUCKET_SIZE = 64
+HISTORY_CANDIDATES = 32
+
+
+def trigrams(text: str):
+    # Word characters only, lowercased, with each word padded so short words
+    # and word boundaries still produce trigrams
+    normalized = " ".join(re.findall(r"\w+", text.lower()))
+    padded = f"  {normalized} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)} if normalized else set()
+
+
+def trigram_hashes(grams):
+    import zlib
+
+    return [zlib.crc32(gram.encode("utf-8")) for gram in grams]
+
+
+def band_keys(hashes):
+    # A one-permutation MinHash sketch of the trigrams: each hash falls in one
+    # of HISTORY_SKETCH_SIZE bins, and a bin keeps the smallest. An empty bin
+    # takes the next full bin to its right, tagged with the distance, so two
+    # sets agree on a bin about as often as their Jaccard similarity. The
+    # sketch is cut into bands of HISTORY_BAND_ROWS bins, one key per band.
+    import array
+    import zlib
+
+    size = HISTORY_SKETCH_SIZE
+    bins = [None] * size
+    for value in hashes:
+        if bins[value % size] is None or value // size < bins[value % size]:
+            bins[value % size] = value // size
+    sketch = list(bins)
+    for i in range(size):
+        distance = 1
+        while sketch[i] is None:
+            if bins[(i + distance) % size] is not None:
+                sketch[i] = distance << 32 | bins[(i + distance) % size]
+            distance += 1
+    packed = array.array("Q", sketch).tobytes()
+    width = 8 * HISTORY_BAND_ROWS
+    return [
+        zlib.crc32(packed[start : start + width], band)
+        for band, start in enumerate(range(0, len(packed), width))
+    ]
+
+
+class CommandHistory:
+    # Append-only log of prompts and the commands that were run for them.
+    # Each distinct prompt is indexed once, by the band keys of its trigrams,
+    # and each distinct (prompt, command) pair points at the last time it
+    # was run, so a prompt asked a thousand times costs a search no more than
+    # one asked once.
+    def __init__(self, path: str = HISTORY_PATH) -> None:
+        import sqlite3
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA mmap_size = 268435456")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS history "
+                "(id INTEGER PRIMARY KEY, time REAL, prompt TEXT, command TEXT)"
+            )
+            # the trigram hashes, packed, so scoring a prompt doesn't have to
+            # recompute them
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS prompts "
+                "(id INTEGER PRIMARY KEY, prompt TEXT UNIQUE, trigrams BLOB)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS runs (prompt INTEGER, command TEXT, "
+                "last_entry INTEGER, time REAL, PRIMARY KEY (prompt, command)) "
+                "WITHOUT ROWID"
+            )
+            # the ids of the last HISTORY_BUCKET_SIZE prompts with a band key,
+            # packed, newest first
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key INTEGER PRIMARY KEY, "
+                "prompts BLOB)"
+            )
+
+    def add(self, prompt: str, command: str) -> None:
+        import array
+
+        now = time.time()
+        with self.db:
+            entry = self.db.execute(
+                "INSERT INTO history (time, prompt, command) VALUES (?, ?, ?)",
+                (now, prompt, command),
+            ).lastrowid
+            row = self.db.execute(
+                "SELECT id FROM prompts WHERE prompt = ?", (prompt,)
+            ).fetchone()
+            if row is not None:
+                prompt_id = row[0]
+            else:
+                hashes = trigram_hashes(trigrams(prompt))
+                prompt_id = self.db.execute(
+                    "INSERT INTO prompts (prompt, trigrams) VALUES (?, ?)",
+                    (prompt, array.array("I", hashes).tobytes()),
+                ).lastrowid
+                if hashes:
+                    packed_id = array.array("I", [prompt_id]).tobytes()
+                    self.db.executemany(
+                        "INSERT INTO buckets VALUES (?, ?) ON CONFLICT(key) "
+                        "DO UPDATE SET prompts = "
+                        "substr(CAST(excluded.prompts || prompts AS BLOB), 1, ?)",
+                        [
+                            (key, packed_id, 4 * HISTORY_BUCKET_SIZE)
+                            for key in band_keys(hashes)
+                        ],
+                    )
+            self.db.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?) ON CONFLICT(prompt, command) "
+                "DO UPDATE SET last_entry = excluded.last_entry, time = excluded.time",
+                (prompt_id, command, entry, now),
+            )
+
+    def search(self, prompt: str, limit: int = 3, threshold: float = 0.2):
+        # Ranks past runs by the Jaccard similarity of their prompt's trigrams
+        # to this one, then by how recent they are, and returns
+        # (similarity, prompt, command, time) tuples, one per distinct
+        # command. Only the HISTORY_CANDIDATES prompts that share the most
+        # band keys with this one are scored, so the similarities are exact
+        # but a match can be missed: a prompt below about 0.5 similar rarely
+        # shares a key, and a key shared by more than HISTORY_BUCKET_SIZE
+        # prompts only remembers the newest. An exact repeat is always found.
+        import array
+        from collections import Counter
+
+        hashes = trigram_hashes(trigrams(prompt))
+        if not hashes or threshold <= 0:
+            return []
+        keys = band_keys(hashes)
+        buckets = self.db.execute(
+            f"SELECT prompts FROM buckets WHERE key IN ({', '.join('?' * len(keys))})",
+            keys,
+        )
+        found = Counter(array.array("I", b"".join(blob for (blob,) in buckets)))
+        row = self.db.execute(
+            "SELECT id FROM prompts WHERE prompt = ?", (prompt,)
+        ).fetchone()
+        if row is not None:
+            found[row[0]] += len(keys)
+
+        candidates = [
+            prompt_id for prompt_id, _ in found.most_common(HISTORY_CANDIDATES)
+        ]
+        hashes = set(hashes)
+        similar = []
+        rows = self.db.execute(
+            "SELECT id, prompt, trigrams FROM prompts "
+            "WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(candidates),),
+        )
+        for prompt_id, past_prompt, packed in rows:
+            past_hashes = array.array("I", packed)
+            shared = len(hashes.intersection(past_hashes))
+            similarity = shared / (len(hashes) + len(past_hashes) - shared)
+            if similarity >= threshold:
+                similar.append((similarity, prompt_id, past_prompt))
+        similar.sort(reverse=True)
+
+        # Read the runs of the most similar prompts a few at a time, since
+        # most searches only need the first
+        matches = {}
+        start = 0
+        while start < len(similar) and len(matches) < limit:
+            # the next `limit` prompts, and any tied with the last of them
+            end = min(start + limit, len(similar))
+            while end < len(similar) and similar[end][0] == similar[end - 1][0]:
+                end += 1
+            batch = {prompt_id: (s, p) for s, prompt_id, p in similar[start:end]}
+            runs = self.db.execute(
+                "SELECT prompt, command, last_entry, time FROM runs "
+                "WHERE prompt IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(batch)),),
+            ).fetchall()
+            runs.sort(key=lambda run: (batch[run[0]][0], run[2]), reverse=True)
+            for prompt_id, command, _, timestamp in runs:
+                similarity, past_prompt = batch[prompt_id]
+                if len(matches) < limit:
+                    matches.setdefault(
+                        command, (similarity, past_prompt, command, timestamp)
+                    )
+            start = end
+        return list(matches.values())
+
+    def recent(self, limit: int = 20):
+        rows = self.db.execute(
+            "SELECT 1.0, prompt, command, time FROM history ORDER BY id DESC LIMIT ?",
+            (limit,),
+        )
+        return list(rows)
+
+
+def print_history(query: str) -> None:
+    if not os.path.exists(HISTORY_PATH):
+        print("No history yet.")
+        return
+    history = CommandHistory()
+    entries = history.search(query, limit=20) if query else history.recent()
+    for _, prompt, command, timestamp in entries:
+        date = time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+        console.print(f"{date}  {prompt}", style="dim", highlight=False, markup=False)
+        console.print(f"  {command}", style="bold", highlight=False, markup=False)
+
+
+def choose_from_history(history: CommandHistory, prompt: str):
+    # Offers commands previously run for similar prompts, before asking the
+    # model. Returns the chosen command, or None to go ahead with the model.
+    with profiled("history search"):
+        matches = history.search(prompt, threshold=HISTORY_MATCH_THRESHOLD)
+    if not matches:
+        return None
+    console.print("From your history:", style="bold")
+    for number, (_, past_prompt, command, _) in enumerate(matches, 1):
+        console.print(
+            f"  {number}. {command}  ({past_prompt})", highlight=False, markup=False
+        )
+    choice = input("Use one of these? [number, or enter to ask chatGPT]: ")
+    if choice.isdigit() and 1 <= int(choice) <= len(matches):
+        return matches[int(choice) - 1][2]
+    return None
+
+
+CODE_BLOCK_PATTERN = re.compile(r"```(.+?)```", re.S)
+CODE_SNIPPET_PATTERN = re.compile(r"`(.+?)`", re.S)
+
+
+def find_code_block(response: str):
+    code_block_match = CODE_BLOCK_PATTERN.search(response)
+    if code_block_match:
+        return code_block_match.group(1).strip()
+    code_snippet_match = CODE_SNIPPET_PATTERN.search(response)
+    if code_snippet_match:
+        return code_snippet_match.group(1).strip()
+    return None
+
+
+class CodeBlockExtractor:
+    # Finds the same command as find_code_block, but in a reply that arrives
+    # in pieces. A fenced block is reported as soon as its closing fence
+    # arrives. Inline snippets are only settled once the reply is complete,
+    # because a fenced block further on takes precedence over them.
     def __init__(self) -> None:
+        self.text = ""
+        self.fence_start = -1
+
+    def feed(self, chunk: str):
+        # a fence can straddle two chunks, so look back a couple characters
+        search_from = max(len(self.text) - 2, 0)
+        self.text += chunk
+        if self.fence_start == -1:
+            self.fence_start = self.text.find("```", search_from)
+            if self.fence_start == -1:
+                return None
+            search_from = self.fence_start
+        fence_end = self.text.find("```", max(search_from, self.fence_start + 4))
+        if fence_end == -1:
+            return None
+        return self.text[self.fence_start + 3 : fence_end].strip()
+
+    def finish(self):
+        return find_code_block(self.text)
+
+
+class StreamedReply:
+    def __init__(self, deltas: Iterator[str], on_complete=None) -> None:
+        self.deltas = deltas
+        self.on_complete = on_complete
+        self.chunks = []
+        self.drain_thread = None
+
+    def render(self) -> str:
+        for delta in self.deltas:
+            self.chunks.append(delta)
+            console.print(delta, end="", style="green", highlight=False, markup=False)
+        console.print("")
+        return self.complete()
+
+    def render_until_command(self):
+        # Show the reply as it arrives, and stop as soon as it contains a
+        # command. The rest is collected quietly in the background, so the
+        # user can already decide what to do with the command.
+        extractor = CodeBlockExtractor()
+        for delta in self.deltas:
+            self.chunks.append(delta)
+            console.print(delta, end="", style="green", highlight=False, markup=False)
+            command = extractor.feed(delta)
+            if command is not None:
+                console.print("")
+                self.drain_thread = threading.Thread(target=self.drain, daemon=True)
+                self.drain_thread.start()
+                return command
+        console.print("")
+        self.complete()
+        return extractor.finish()
+
+    def drain(self) -> None:
+        try:
+            for delta in self.deltas:
+                self.chunks.append(delta)
+        except Exception as e:
+            console.print(e, style="red")
+            return
+        self.complete()
+
+    def complete(self) -> str:
+        content = "".join(self.chunks)
+        if self.on_complete is not None:
+            self.on_complete(content)
+        return content
+
+    def content(self) -> str:
+        if self.drain_thread is not None:
+            self.drain_thread.join()
+        return "".join(self.chunks)
+
+
+TOKEN_BUDGET = int(os.environ.get("CHATBASH_TOKEN_BUDGET", 3000))
+MAX_RETRIES = int(os.environ.get("CHATBASH_MAX_RETRIES", 3))
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(content: str) -> int:
+    # Roughly four characters per token for English text, plus the few tokens
+    # of framing the API adds to every message. Cached, so each message is
+    # only counted once however many times it is resent.
+    return len(content) // 4 + 4
+
+
+def command_request(prompt: str):
+    return [
+        {
+            "role": "system",
+            "content": "Your goal is to collaborate with the user to generate a bash command. Only respond with one bash command per reply",
+        },
+        {
+            "role": "user",
+            "content": f"given the following prompt, generate a bash command. do not use any formatting. Do not provide any commentary: {prompt}",
+        },
+    ]
+
+
+def explanation_request(command: str) -> Dict:
+    return {
+        "role": "user",
+        "content": f"give a concise explanation of the following bash command: {command}",
+    }
+
+
+def verify_request(command: str) -> Dict:
+    return {
+        "role": "user",
+        "content": f"echo the command if correct, or revise if there are errors: {command}",
+    }
+
+
+PREFETCH_TOKEN_CAP = int(os.environ.get("CHATBASH_PREFETCH_TOKENS", 20000))
+
+
+class Speculation:
+    def __init__(self) -> None:
+        self.conversation = None
+        self.content = None
+        self.built = threading.Event()
+        self.done = threading.Event()
+
+
+class Prefetcher:
+    # Requests the replies the user is likely to ask for next while they are
+    # still reading the command. A speculative reply is only used if it was
+    # made for exactly the conversation the user ends up with; otherwise it is
+    # thrown away. The threads are daemons, so running or quitting doesn't
+    # wait for them.
+    def __init__(self, chat, token_cap: int = PREFETCH_TOKEN_CAP) -> None:
+        self.chat = chat
+        self.token_cap = token_cap
+        self.tokens_spent = 0
+        self.lock = threading.Lock()
+        self.speculations = {}
+
+    def start(self, kind: str, build_conversation) -> None:
+        speculation = Speculation()
+        self.speculations[kind] = speculation
+
+        def run():
+            try:
+                conversation = build_conversation()
+                speculation.conversation = conversation
+                speculation.built.set()
+                cost = min(
+                    sum(count_tokens(message["content"]) for message in conversation),
+                    self.chat.token_budget,
+                )
+                with self.lock:
+                    if self.tokens_spent + cost > self.token_cap:
+                        return
+                    self.tokens_spent += cost
+                speculation.content = self.chat.chat_gpt(
+                    conversation, speculative=True
+                )["content"]
+            except ChatError:
+                pass
+            finally:
+                speculation.built.set()
+                speculation.done.set()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def take(self, kind: str, conversation):
+        speculation = self.speculations.pop(kind, None)
+        if speculation is None:
+            return None
+        # Building only waits for a streamed reply the real request needs
+        # too. A stale speculation is dropped before waiting for its reply.
+        speculation.built.wait()
+        if speculation.conversation != conversation:
+            return None
+        speculation.done.wait()
+        return speculation.content
+
+    def discard(self) -> None:
+        self.speculations.clear()
+
+
+class RateLimiter:
+    def __init__(self, per_minute: float) -> None:
+        self.interval = 60 / per_minute
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        # Hand out evenly spaced slots, so concurrent workers don't burst
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class ChatHandler:
+    def __init__(
+        self,
+        use_cache: bool = True,
+        stream: bool = False,
+        token_budget: int = TOKEN_BUDGET,
+        show_context: bool = False,
+        use_daemon: bool = True,
+        max_retries: int = MAX_RETRIES,
+        rate_limiter: RateLimiter = None,
+        prefetch: bool = False,
+        prefetch_verify: bool = False,
+    ) -> None:
         self.set_api_key()
         self.conversation = []
+        self.cache = ResponseCache() if use_cache else None
+        self.stream = stream
+        self.pending_reply = None
+        self.token_budget = token_budget
+        self.show_context = show_context
+        self.explanation_messages = []
+        self.use_daemon = use_daemon
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+        self.prefetcher = Prefetcher(self) if prefetch or prefetch_verify else None
+        self.prefetch_verify = prefetch_verify
+
+    def context_window(self, conversation, speculative: bool = False):
+        # Trim the conversation to the token budget. System messages, the
+        # task prompt, the latest command and the last two messages are
+        # always sent. Past that, explanation turns go first, since they are
+        # long and rarely needed again, then the oldest messages. An
+        # explanation request and its reply are dropped together.
+        # Speculative requests run while the user is at the prompt, so they
+        # don't print the context.
+        total = sum(count_tokens(message["content"]) for message in conversation)
+        pinned = {len(conversation) - 2, len(conversation) - 1}
+        for i, message in enumerate(conversation):
+            if message["role"] == "user":
+                pinned.add(i)
+                break
+        for i in reversed(range(len(conversation))):
+            message = conversation[i]
+            if message["role"] == "assistant" and not self.is_explanation(message):
+                pinned.add(i)
+                break
+
+        turns = []
+        i = 0
+        while i < len(conversation):
+            size = 1
+            if (
+                self.is_explanation(conversation[i])
+                and conversation[i]["role"] == "user"
+                and i + 1 < len(conversation)
+                and self.is_explanation(conversation[i + 1])
+            ):
+                size = 2
+            turns.append(range(i, i + size))
+            i += size
+        droppable = [
+            turn
+            for turn in turns
+            if all(
+                conversation[i]["role"] != "system" and i not in pinned for i in turn
+            )
+        ]
+        droppable.sort(key=lambda turn: not self.is_explanation(conversation[turn[0]]))
+
+        dropped = set()
+        for turn in droppable:
+            if total <= self.token_budget:
+                break
+            dropped.update(turn)
+            total -= sum(count_tokens(conversation[i]["content"]) for i in turn)
+
+        window = [m for i, m in enumerate(conversation) if i not in dropped]
+        if self.show_context and not speculative:
+            self.print_context(conversation, dropped, total)
+        return window
+
+    def is_explanation(self, message) -> bool:
+        return any(message is m for m in self.explanation_messages)
+
+    def print_context(self, conversation, dropped, total) -> None:
+        console.print(
+            f"Sending {len(conversation) - len(dropped)} of {len(conversation)} "
+            f"messages, ~{total} of {self.token_budget} tokens:",
+            style="dim",
+        )
+        for i, message in enumerate(conversation):
+            marker = "-" if i in dropped else "+"
+            preview = message["content"].replace("\n", " ")[:60]
+            console.print(
+                f"  {marker} {message['role']:<9} {count_tokens(message['content']):>5} {preview}",
+                style="dim",
+                highlight=False,
+                markup=False,
+            )
 
     def set_api_key(self):
         try:
-            openai.api_key = os.environ["OPENAI_API_KEY"]
+            self.api_key = os.environ["OPENAI_API_KEY"]
         except KeyError:
             print("Error: Could not set API key")
             sys.exit(1)
 
-    def chat_gpt(self, conversation):
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4", messages=conversation, temperature=0.1
-            )
-            content = response["choices"][0]["message"]["content"]
+    def chat_gpt(self, conversation, use_cache: bool = True, speculative: bool = False):
+        # Speculative requests are made for replies the user may never ask
+        # for, so they don't count towards the cache's hits and misses
+        conversation = self.context_window(conversation, speculative)
+        with profiled("chat_gpt", messages=len(conversation)) as info:
+            # serializing the whole window is only worth it for the trace
+            if profiler is not None:
+                info["request_bytes"] = len(json.dumps(conversation))
+            if self.cache is not None and use_cache:
+                content = self.cache.get(conversation, count=not speculative)
+                if content is not None:
+                    info.update(cached=True, response_bytes=len(content))
+                    return {"role": "assistant", "content": content}
+
+            content = self.with_retries(self.request, conversation)
+            info.update(cached=False, response_bytes=len(content))
+            if self.cache is not None:
+                self.cache.put(conversation, content)
             return {"role": "assistant", "content": content}
-        except Exception as e:
-            console.print(e, style="red")
-            sys.exit(1)
 
-    def update_conversation(self, append: Dict = None) -> None:
+    def request(self, conversation) -> str:
+        content = None
+        if self.use_daemon:
+            content = request_completion_from_daemon(conversation, self.api_key)
+        if content is None:
+            content = request_completion(conversation, self.api_key)
+        return content
+
+    def with_retries(self, request, conversation):
+        # Retry transient errors with exponential backoff and jitter, and
+        # raise a ChatError once retrying doesn't help.
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            try:
+                return request(conversation)
+            except Exception as e:
+                error = e if isinstance(e, ChatError) else ChatError(e, is_transient(e))
+            if not error.transient or attempt == self.max_retries:
+                raise error
+            time.sleep(2**attempt + random.random())
+
+    def stream_gpt(self, conversation, use_cache: bool = True) -> StreamedReply:
+        self.finish_pending_reply()
+        conversation = self.context_window(conversation)
+        if self.cache is not None and use_cache:
+            content = self.cache.get(conversation)
+            if content is not None:
+                return StreamedReply(iter([content]))
+
+        def on_complete(content):
+            if self.cache is not None:
+                self.cache.put(conversation, content)
+
+        def start_stream(conversation):
+            deltas = None
+            if self.use_daemon:
+                deltas = request_completion_stream_from_daemon(
+                    conversation, self.api_key
+                )
+            if deltas is None:
+                deltas = request_completion_stream(conversation, self.api_key)
+            # make the request now, so connection errors surface here
+            return next(deltas, ""), deltas
+
+        with profiled("stream_gpt first token", messages=len(conversation)) as info:
+            if profiler is not None:
+                info["request_bytes"] = len(json.dumps(conversation))
+            first, deltas = self.with_retries(start_stream, conversation)
+
+        def prepend_first():
+            yield first
+            yield from deltas
+
+        return StreamedReply(prepend_first(), on_complete)
+
+    def finish_pending_reply(self) -> None:
+        # A streamed reply whose command has already been shown may still be
+        # arriving. Wait for the rest before touching the conversation again.
+        if self.pending_reply is not None:
+            reply, self.pending_reply = self.pending_reply, None
+            self.update_conversation(
+                {"role": "assistant", "content": reply.content()}, echo=False
+            )
+
+    def update_conversation(self, append: Dict = None, echo: bool = True) -> None:
+        self.finish_pending_reply()
         if append is not None:
             self.conversation.append(append)
             role = append["role"]
             content = append["content"]
-            console.print(f"{role.capitalize()}: {content}", style="green")
+            if echo:
+                console.print(f"{role.capitalize()}: {content}", style="green")
+
+    def generate_command(self, conversation, use_cache: bool = True) -> str:
+        if not self.stream:
+            response = self.chat_gpt(conversation, use_cache)["content"]
+            self.update_conversation({"role": "assistant", "content": response})
+            return self.extract_code_block(response)
+
+        reply = self.stream_gpt(conversation, use_cache)
+        console.print("Assistant: ", end="", style="green")
+        command = reply.render_until_command()
+        self.pending_reply = reply
+        if command is not None:
+            return command
+        self.finish_pending_reply()
+        return self.extract_code_block(reply.content())
 
     def extract_code_block(self, response: str) -> str:
-        code_block_pattern = r"```(.+?)```"
-        code_snippet_pattern = r"`(.+?)`"
-        code_block_match = re.search(code_block_pattern, response, re.S)
-        code_snippet_match = re.search(code_snippet_pattern, response, re.S)
-        if code_block_match:
-            return code_block_match.group(1).strip()
-        elif code_snippet_match:
-            return code_snippet_match.group(1).strip()
+        with profiled("extract_code_block", response_bytes=len(response)):
+            command = find_code_block(response)
+        if command is not None:
+            return command
         else:
             save_flag = input(
                 "would you like to save this reply as the command? (y/n): "
@@ -92,41 +1508,82 @@ class ChatHandler:
             else:
                 pass
 
+    def prefetch(self, command: str) -> None:
+        if self.prefetcher is None:
+            return
+        conversation = list(self.conversation)
+        pending_reply = self.pending_reply
+
+        def build(request):
+            # A streamed reply may still be arriving. The speculative request
+            # waits for it in the background rather than holding up the prompt.
+            def build_conversation():
+                if pending_reply is None:
+                    return conversation + [request]
+                reply = {"role": "assistant", "content": pending_reply.content()}
+                return conversation + [reply, request]
+
+            return build_conversation
+
+        self.prefetcher.start("explain", build(explanation_request(command)))
+        if self.prefetch_verify:
+            self.prefetcher.start("verify", build(verify_request(command)))
+
+    def take_prefetched(self, kind: str):
+        if self.prefetcher is None:
+            return None
+        return self.prefetcher.take(kind, self.conversation)
+
+    def discard_prefetched(self) -> None:
+        if self.prefetcher is not None:
+            self.prefetcher.discard()
+
     def request_explanation(self, command: str) -> str:
-        explanation_request = (
-            f"give a concise explanation of the following bash command: {command}"
-        )
-        self.update_conversation({"role": "user", "content": explanation_request})
-        explanation = self.chat_gpt(self.conversation)["content"]
-        self.update_conversation({"role": "assistant", "content": explanation})
+        self.update_conversation(explanation_request(command))
+        self.explanation_messages.append(self.conversation[-1])
+        explanation = self.take_prefetched("explain")
+        if explanation is not None:
+            self.update_conversation({"role": "assistant", "content": explanation})
+        elif self.stream:
+            console.print("Assistant: ", end="", style="green")
+            explanation = self.stream_gpt(self.conversation).render()
+            self.update_conversation(
+                {"role": "assistant", "content": explanation}, echo=False
+            )
+        else:
+            explanation = self.chat_gpt(self.conversation)["content"]
+            self.update_conversation({"role": "assistant", "content": explanation})
+        self.explanation_messages.append(self.conversation[-1])
 
     def refine_prompt(self, user_feedback: str) -> str:
-        refined_prompt = self.chat_gpt(self.conversation)["content"]
-        self.update_conversation({"role": "assistant", "content": refined_prompt})
-        return refined_prompt
+        return self.generate_command(self.conversation)
 
     def verify_command(self, command: str) -> str:
-        self.update_conversation(
-            {
-                "role": "user",
-                "content": f"echo the command if correct, or revise if there are errors: {command}",
-            }
-        )
-        corrected_command = self.chat_gpt(self.conversation)["content"]
+        self.update_conversation(verify_request(command))
+        corrected_command = self.take_prefetched("verify")
+        if corrected_command is None:
+            corrected_command = self.chat_gpt(self.conversation)["content"]
         edited_command = get_prompt_input(corrected_command)
         self.update_conversation({"role": "user", "content": edited_command})
         return edited_command.strip()
 
     def print_conversation(self):
-        conversation_text = Text("\n\nConversation so far:\n\n", style="bold")
-        for message in self.conversation:
-            role = message["role"]
-            content = message["content"]
-            message_style = "green" if role == "assistant" else "white"
-            conversation_text.append(f"{role.capitalize()}: ", style=message_style)
-            conversation_text.append(f"{content}\n", style=message_style)
-        panel = Panel(conversation_text, box=box.ROUNDED, style="white on black")
-        console.print(panel)
+        self.finish_pending_reply()
+
+        with profiled("print_conversation", messages=len(self.conversation)):
+            from rich import box
+            from rich.panel import Panel
+            from rich.text import Text
+
+            conversation_text = Text("\n\nConversation so far:\n\n", style="bold")
+            for message in self.conversation:
+                role = message["role"]
+                content = message["content"]
+                message_style = "green" if role == "assistant" else "white"
+                conversation_text.append(f"{role.capitalize()}: ", style=message_style)
+                conversation_text.append(f"{content}\n", style=message_style)
+            panel = Panel(conversation_text, box=box.ROUNDED, style="white on black")
+            console.print(panel)
 
 
 def get_prompt_input(prompt: str) -> str:
@@ -141,6 +1598,10 @@ def get_prompt_input(prompt: str) -> str:
 
 
 def welcome_to_chatbash() -> None:
+    from rich.panel import Panel
+    from rich.table import Table
+    from rich.text import Text
+
     title = Text("Welcome to chatbash", style="bold_underline")
     description = Text(
         "This program is designed to help you collaborate with chatGPT to craft a bash command."
@@ -159,48 +1620,228 @@ def welcome_to_chatbash() -> None:
     console.print(instructions)
 
 
+BATCH_WORKERS = int(os.environ.get("CHATBASH_BATCH_WORKERS", 4))
+BATCH_REQUESTS_PER_MINUTE = float(os.environ.get("CHATBASH_BATCH_RPM", 60))
+
+
+def read_batch_items(lines):
+    # Each line is either plain text or a JSON object with a "prompt" or
+    # "command" field. Blank lines and comments are skipped.
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = line
+        if isinstance(item, dict):
+            yield line_number, item.get("command") or item.get("prompt")
+        elif isinstance(item, str):
+            yield line_number, item
+        else:
+            yield line_number, line
+
+
+def run_batch_item(chat: ChatHandler, text: str, explain: bool) -> Dict:
+    if explain:
+        explanation = chat.chat_gpt([explanation_request(text)])["content"]
+        return {"explanation": explanation}
+    response = chat.chat_gpt(command_request(text))["content"]
+    command = find_code_block(response)
+    return {"command": command if command is not None else response.strip()}
+
+
+def run_batch(chat: ChatHandler, lines, explain: bool, workers: int) -> bool:
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    def process(item):
+        line_number, text = item
+        result = {"line": line_number, "input": text}
+        if text is None:
+            result["error"] = "no prompt or command on this line"
+            return result
+        try:
+            result.update(run_batch_item(chat, text, explain))
+        except ChatError as e:
+            result["error"] = str(e)
+        return result
+
+    # Lines are read and submitted on their own thread, while this one
+    # prints results in input order as each becomes ready, so a slow pipe
+    # gets answers as it goes. At most twice as many lines as workers are
+    # queued ahead of the output.
+    ok = True
+    futures = queue.Queue(maxsize=workers * 2)
+    read_errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        def read():
+            try:
+                for item in read_batch_items(lines):
+                    futures.put(executor.submit(process, item))
+            except Exception as e:
+                read_errors.append(e)
+            finally:
+                futures.put(None)
+
+        threading.Thread(target=read, daemon=True).start()
+        while True:
+            future = futures.get()
+            if future is None:
+                break
+            result = future.result()
+            ok = ok and "error" not in result
+            print(json.dumps(result), flush=True)
+    if read_errors:
+        raise read_errors[0]
+    return ok
+
+
 def main():
-    welcome_to_chatbash()
-    chat = ChatHandler()
+    main_started = time.perf_counter()
     args = sys.argv[1:]
     quick_explain = False
+    use_cache = True
+    stream = False
+    show_context = False
+    prefetch = False
+    prefetch_verify = False
+    online = False
+    use_history = True
+
+    if "--profile" in args:
+        global profiler
+        profiler = Profiler()
+        profiler.record("import chatbash", STARTED, main_started)
+        atexit.register(profiler.write)
+        args.remove("--profile")
+
+    if "--setup" in args:
+        with profiled("install_dependencies"):
+            install_dependencies()
+        sys.exit(0)
+
+    if "--daemon" in args:
+        run_daemon()
+        sys.exit(0)
+
+    if "--build-man-index" in args:
+        pages = ManIndex().build()
+        print(f"Indexed {pages} man pages into {MAN_INDEX_PATH}")
+        sys.exit(0)
+
+    if "--cache-stats" in args:
+        stats = ResponseCache().stats()
+        print(
+            f"hits: {stats['hits']}  misses: {stats['misses']}  "
+            f"entries: {stats['entries']}  size: {stats['bytes']} bytes"
+        )
+        sys.exit(0)
+
+    if "--no-cache" in args:
+        use_cache = False
+        args.remove("--no-cache")
+
+    if "--stream" in args:
+        stream = True
+        args.remove("--stream")
+
+    if "--show-context" in args:
+        show_context = True
+        args.remove("--show-context")
+
+    if "--prefetch" in args:
+        prefetch = True
+        args.remove("--prefetch")
+
+    if "--prefetch-verify" in args:
+        prefetch_verify = True
+        args.remove("--prefetch-verify")
+
+    if "--online" in args:
+        online = True
+        args.remove("--online")
+
+    if "--no-history" in args:
+        use_history = False
+        args.remove("--no-history")
+
+    if "--history" in args:
+        args.remove("--history")
+        print_history(" ".join(args))
+        sys.exit(0)
 
     if "-x" in args:
         quick_explain = True
         args.remove("-x")
 
+    if "--batch" in args:
+        index = args.index("--batch")
+        args.pop(index)
+        path = args.pop(index) if index < len(args) else "-"
+        # The daemon only has a few workers of its own, so the batch workers
+        # talk to the API directly. Nothing but JSON lines may go to stdout.
+        chat = ChatHandler(
+            use_cache=use_cache,
+            use_daemon=False,
+            rate_limiter=RateLimiter(BATCH_REQUESTS_PER_MINUTE),
+        )
+        with sys.stdin if path == "-" else open(path) as lines:
+            ok = run_batch(chat, lines, quick_explain, BATCH_WORKERS)
+        sys.exit(0 if ok else 1)
+
     prompt = " ".join(args)
 
-    if prompt == "":
-        if quick_explain:
+    # -x is meant for scripts, so skip the banner and get straight to the
+    # request. The man page index answers it offline when it can.
+    if quick_explain:
+        if prompt == "":
             print("Error: No command provided for quick explanation.")
             sys.exit(1)
-        else:
-            prompt = input("Write a natural language command, or 'q' to quit: ")
-            if prompt == "q":
-                sys.exit(0)
-
-    if quick_explain:
-        explanation = chat.request_explanation(prompt)
+        with profiled("explain_offline") as info:
+            info["covered"] = not online and explain_offline(prompt)
+        if info["covered"]:
+            sys.exit(0)
+        chat = ChatHandler(
+            use_cache=use_cache, stream=stream, show_context=show_context
+        )
+        chat.request_explanation(prompt)
         print("")
         sys.exit(0)
 
-    conversation = [
-        {
-            "role": "system",
-            "content": "Your goal is to collaborate with the user to generate a bash command. Only respond with one bash command per reply",
-        },
-        {
-            "role": "user",
-            "content": f"given the following prompt, generate a bash command. do not use any formatting. Do not provide any commentary: {prompt}",
-        },
-    ]
+    with profiled("welcome_to_chatbash"):
+        welcome_to_chatbash()
+    chat = ChatHandler(
+        use_cache=use_cache,
+        stream=stream,
+        show_context=show_context,
+        prefetch=prefetch,
+        prefetch_verify=prefetch_verify,
+    )
 
-    chat_gpt_response = chat.chat_gpt(conversation)["content"]
-    chat.update_conversation({"role": "assistant", "content": chat_gpt_response})
-    command = chat.extract_code_block(chat_gpt_response)
+    if prompt == "":
+        prompt = input("Write a natural language command, or 'q' to quit: ")
+        if prompt == "q":
+            sys.exit(0)
+
+    chat.conversation.extend(command_request(prompt))
+
+    history = CommandHistory() if use_history else None
+    command = None
+    if history is not None:
+        command = choose_from_history(history, prompt)
+    if command is not None:
+        chat.update_conversation({"role": "assistant", "content": command}, echo=False)
+    else:
+        command = chat.generate_command(chat.conversation)
+    prefetched_command = None
 
     while True:
+        if command != prefetched_command:
+            chat.prefetch(command)
+            prefetched_command = command
         console.print(
             "Careful! Bash commands are powerful... make sure you understand the prompt",
             style="red",
@@ -212,7 +1853,10 @@ def main():
         match run_flag:
             case "r":
                 try:
-                    subprocess.run(command, shell=True, check=True)
+                    with profiled("run command"):
+                        subprocess.run(command, shell=True, check=True)
+                    if history is not None:
+                        history.add(prompt, command)
                     sys.exit(0)
                 except subprocess.CalledProcessError as e:
                     print(f"Error executing the command: {e}")
@@ -224,9 +1868,9 @@ def main():
             case "f":
                 user_feedback = input("Feedback: ")
                 print("\n\n")
+                chat.discard_prefetched()
                 chat.update_conversation({"role": "user", "content": user_feedback})
-                refined_prompt = chat.refine_prompt(user_feedback)
-                command = chat.extract_code_block(refined_prompt)
+                command = chat.refine_prompt(user_feedback)
             case "e":
                 print("\n\n")
                 corrected_command = chat.verify_command(command)
@@ -239,16 +1883,24 @@ def main():
                 sys.exit(0)
             case "t":
                 print("\n\n")
+                chat.discard_prefetched()
+                chat.finish_pending_reply()
                 if chat.conversation:
                     chat.conversation.pop()
-                chat_gpt_response = chat.chat_gpt(chat.conversation)["content"]
-                chat.update_conversation(
-                    {"role": "assistant", "content": chat_gpt_response}
-                )
-                command = chat.extract_code_block(chat_gpt_response)
+                # a retry wants a fresh answer, not the cached one
+                command = chat.generate_command(chat.conversation, use_cache=False)
             case _:
                 continue
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except ChatError as e:
+        console.print(e, style="red")
+        sys.exit(1)
+    except ImportError as e:
+        # the panels and tables rich draws are imported where they're used
+        if e.name is None or e.name.split(".")[0] not in ("openai", "rich"):
+            raise
+        exit_missing_dependency(e)
@@ -12,6 +12,10 @@ if [ "$(id -u)" -ne 0 ]; then
     exit 1 
 fi
 
+# Install the Python dependencies once, so chatbash doesn't have to on every launch
+echo "Installing Python dependencies..."
+python3 "$program_file" --setup
+
 # Copy the program to /usr/local/bin and set the executable permission
 echo "Copying program..."
 cp "$program_file" "/usr/local/bin/$program_name"
@@ -45,3 +49,5 @@ else
     exit 1 
 fi
 
+
+echo "Run 'chatbash --build-man-index' as your own user to let 'chatbash -x' explain commands offline."
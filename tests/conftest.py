@@ -0,0 +1,40 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# chatbash reads its paths when it's imported, so keep it away from the
+# user's daemon, caches and history before that happens
+workdir = tempfile.mkdtemp(prefix="chatbash-tests-")
+os.environ.update(
+    OPENAI_API_KEY="sk-test",
+    CHATBASH_SOCKET=os.path.join(workdir, "no-daemon.sock"),
+    CHATBASH_CACHE=os.path.join(workdir, "responses.sqlite"),
+    CHATBASH_MAN_INDEX=os.path.join(workdir, "man.sqlite"),
+    CHATBASH_HISTORY=os.path.join(workdir, "history.sqlite"),
+)
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    from fake_openai import start_fake_server
+
+    servers = []
+
+    def start(**options):
+        server, url = start_fake_server(**options)
+        servers.append(server)
+        monkeypatch.setenv("OPENAI_API_BASE", url)
+        import openai
+
+        monkeypatch.setattr(openai, "api_base", url)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
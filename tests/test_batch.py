@@ -0,0 +1,129 @@
+import io
+import json
+import time
+from contextlib import redirect_stdout
+
+import pytest
+
+import chatbash
+
+
+def batch_chat(**options):
+    return chatbash.ChatHandler(use_cache=False, use_daemon=False, **options)
+
+
+def run_batch(chat, lines, workers=4, explain=False):
+    output = io.StringIO()
+    with redirect_stdout(output):
+        ok = chatbash.run_batch(chat, lines, explain, workers)
+    return ok, [json.loads(line) for line in output.getvalue().splitlines()]
+
+
+def test_results_come_back_in_input_order(fake_api):
+    fake_api(latency_ms=20)
+    prompts = [f"list files in directory {i}" for i in range(20)]
+
+    ok, results = run_batch(batch_chat(), prompts)
+
+    assert ok
+    assert [result["input"] for result in results] == prompts
+    assert [result["line"] for result in results] == list(range(1, 21))
+    assert results[3]["command"] == "echo list-files-in-directory-3"
+
+
+def test_explain_and_json_lines(fake_api):
+    fake_api()
+    lines = ['{"command": "ls -la"}', "", "# a comment", '{"other": 1}']
+
+    ok, results = run_batch(batch_chat(), lines, explain=True)
+
+    assert not ok
+    assert results[0]["line"] == 1
+    assert "ls -la" in results[0]["explanation"]
+    assert results[1] == {
+        "line": 4,
+        "input": None,
+        "error": "no prompt or command on this line",
+    }
+
+
+def test_transient_errors_are_retried(fake_api):
+    server = fake_api(fail_every=3)
+    prompts = [f"show disk usage {i}" for i in range(6)]
+
+    ok, results = run_batch(batch_chat(max_retries=2), prompts, workers=2)
+
+    assert ok
+    assert [result["input"] for result in results] == prompts
+    assert server.request_count > len(prompts)
+
+
+def test_failures_are_reported_per_line(fake_api):
+    fake_api(fail_every=1)
+
+    ok, results = run_batch(batch_chat(max_retries=0), ["list files"])
+
+    assert not ok
+    assert "overloaded" in results[0]["error"]
+
+
+def test_results_are_printed_before_input_ends(fake_api):
+    # A slow pipe: each line after the first is only read once the one
+    # before it has been answered, which deadlocks if run_batch waits for
+    # the end of its input.
+    fake_api()
+    output = io.StringIO()
+    read_ahead = []
+
+    def slow_lines(count, workers):
+        for i in range(count):
+            deadline = time.monotonic() + 5
+            while output.getvalue().count("\n") < i - 2 * workers - 1:
+                assert time.monotonic() < deadline, "no output before end of input"
+                time.sleep(0.01)
+            read_ahead.append(i - output.getvalue().count("\n"))
+            yield f"list files in directory {i}"
+
+    with redirect_stdout(output):
+        ok = chatbash.run_batch(batch_chat(), slow_lines(20, 2), False, 2)
+
+    assert ok
+    assert output.getvalue().count("\n") == 20
+    assert max(read_ahead) <= 2 * 2 + 2
+
+
+def test_reader_waits_for_the_output(fake_api):
+    # However fast the input, only a few lines are queued ahead of the
+    # slowest request.
+    fake_api(latency_ms=50)
+    consumed = []
+    printed = io.StringIO()
+
+    def lines():
+        for i in range(30):
+            consumed.append(printed.getvalue().count("\n"))
+            yield f"list files in directory {i}"
+
+    with redirect_stdout(printed):
+        chatbash.run_batch(batch_chat(), lines(), False, 2)
+
+    assert all(i - done <= 2 * 2 + 2 for i, done in enumerate(consumed))
+
+
+def test_main_batch_mode(fake_api, monkeypatch, tmp_path, capsys):
+    fake_api()
+    path = tmp_path / "prompts.txt"
+    path.write_text("list files\nshow disk usage\n")
+    monkeypatch.setattr(chatbash, "BATCH_REQUESTS_PER_MINUTE", 100000)
+    monkeypatch.setattr("sys.argv", ["chatbash", "--no-cache", "--batch", str(path)])
+
+    with pytest.raises(SystemExit) as exit:
+        chatbash.main()
+
+    assert exit.value.code == 0
+
+    results = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [result["command"] for result in results] == [
+        "echo list-files",
+        "echo show-disk-usage",
+    ]
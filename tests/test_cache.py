@@ -0,0 +1,109 @@
+import zlib
+
+import pytest
+
+import chatbash
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(chatbash.time, "time", clock)
+    return clock
+
+
+def make_cache(tmp_path, **options):
+    return chatbash.ResponseCache(str(tmp_path / "responses.sqlite"), **options)
+
+
+def conversation(prompt):
+    return chatbash.command_request(prompt)
+
+
+def test_hits_and_misses_are_counted(tmp_path, clock):
+    cache = make_cache(tmp_path)
+
+    assert cache.get(conversation("list files")) is None
+    cache.put(conversation("list files"), "ls")
+    assert cache.get(conversation("list files")) == "ls"
+    # whitespace at the edges of a message doesn't matter
+    assert cache.get(conversation("list files  ")) == "ls"
+    assert cache.get(conversation("show disk usage")) is None
+    assert cache.get(conversation("show disk usage"), count=False) is None
+
+    assert cache.stats() == {
+        "hits": 2,
+        "misses": 2,
+        "entries": 1,
+        "bytes": len(zlib.compress(b"ls")),
+    }
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = make_cache(tmp_path, ttl=60)
+    cache.put(conversation("list files"), "ls")
+
+    clock.now += 59
+    assert cache.get(conversation("list files")) == "ls"
+    clock.now += 1
+    assert cache.get(conversation("list files")) is None
+    assert cache.stats()["entries"] == 1
+
+    # expired entries are removed the next time something is stored
+    cache.put(conversation("show disk usage"), "du -sh")
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path, clock):
+    replies = {prompt: prompt.upper() * 20 for prompt in "abcd"}
+    size = len(zlib.compress(replies["a"].encode("utf-8")))
+    cache = make_cache(tmp_path, max_bytes=3 * size)
+
+    for prompt in "abc":
+        clock.now += 1
+        cache.put(conversation(prompt), replies[prompt])
+    clock.now += 1
+    assert cache.get(conversation("a")) == replies["a"]
+
+    clock.now += 1
+    cache.put(conversation("d"), replies["d"])
+
+    # b was used longest ago
+    assert cache.get(conversation("b")) is None
+    for prompt in "acd":
+        assert cache.get(conversation(prompt)) == replies[prompt]
+    assert cache.stats()["entries"] == 3
+    assert cache.stats()["bytes"] == 3 * size
+
+
+def test_an_entry_over_the_budget_is_not_kept(tmp_path, clock):
+    cache = make_cache(tmp_path, max_bytes=10)
+    cache.put(conversation("list files"), "ls")
+    clock.now += 1
+    cache.put(conversation("a lot"), "".join(map(str, range(100))))
+
+    assert cache.get(conversation("a lot")) is None
+    assert cache.get(conversation("list files")) == "ls"
+
+
+def test_speculative_lookups_are_not_counted(fake_api, tmp_path):
+    fake_api()
+    chat = chatbash.ChatHandler(use_daemon=False)
+    chat.cache = make_cache(tmp_path)
+
+    chat.chat_gpt(conversation("list files"), speculative=True)
+    chat.chat_gpt(conversation("list files"), speculative=True)
+    assert chat.cache.stats()["hits"] == chat.cache.stats()["misses"] == 0
+
+    chat.chat_gpt(conversation("list files"))
+    assert chat.cache.stats()["hits"] == 1
@@ -0,0 +1,107 @@
+import chatbash
+
+
+def make_chat(token_budget):
+    return chatbash.ChatHandler(
+        use_cache=False, use_daemon=False, token_budget=token_budget
+    )
+
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+
+def explain(chat, command, explanation):
+    # The way request_explanation marks the pair it adds
+    request = chatbash.explanation_request(command)
+    reply = message("assistant", explanation)
+    chat.explanation_messages += [request, reply]
+    return [request, reply]
+
+
+def session(chat):
+    long = "word " * 200
+    return [
+        *chatbash.command_request("find big files"),
+        message("assistant", "find / -size +1G"),
+        message("user", "only in my home directory " + long),
+        message("assistant", "find ~ -size +1G"),
+        *explain(chat, "find ~ -size +1G", "It finds files " + long),
+        message("user", "and sort them by size " + long),
+        message("assistant", "find ~ -size +1G | sort"),
+        *explain(chat, "find ~ -size +1G | sort", "It sorts them " + long),
+    ]
+
+
+def test_everything_fits_in_a_large_budget():
+    chat = make_chat(token_budget=100000)
+    conversation = session(chat)
+    assert chat.context_window(conversation) == conversation
+
+
+def test_pinned_messages_are_kept_in_any_budget():
+    chat = make_chat(token_budget=0)
+    conversation = session(chat)
+
+    window = chat.context_window(conversation)
+
+    # the system prompt, the task, the latest command (not the explanation
+    # after it) and the last two messages
+    assert window == [
+        conversation[0],
+        conversation[1],
+        conversation[8],
+        conversation[9],
+        conversation[10],
+    ]
+
+
+def test_explanations_go_before_other_turns():
+    chat = make_chat(token_budget=0)
+    conversation = session(chat)
+    # just enough room for everything but the older explanation
+    explanation = conversation[5:7]
+    chat.token_budget = sum(
+        chatbash.count_tokens(m["content"])
+        for m in conversation
+        if not any(m is e for e in explanation)
+    )
+
+    window = chat.context_window(conversation)
+
+    assert window == conversation[:5] + conversation[7:]
+
+
+def test_an_explanation_request_and_its_reply_go_together():
+    chat = make_chat(token_budget=0)
+    conversation = session(chat)
+    # room for all but the explanation request, which is much shorter than
+    # its reply
+    chat.token_budget = sum(
+        chatbash.count_tokens(m["content"]) for m in conversation
+    ) - chatbash.count_tokens(conversation[5]["content"])
+
+    window = chat.context_window(conversation)
+
+    assert conversation[5] not in window
+    assert conversation[6] not in window
+    assert len(window) == len(conversation) - 2
+
+
+def test_the_oldest_turns_go_once_explanations_are_gone():
+    chat = make_chat(token_budget=0)
+    conversation = session(chat)
+    kept = conversation[:2] + conversation[7:]
+    chat.token_budget = sum(chatbash.count_tokens(m["content"]) for m in kept)
+    chat.token_budget += chatbash.count_tokens(conversation[4]["content"])
+
+    window = chat.context_window(conversation)
+
+    # the older explanation goes first, then the oldest messages, until the
+    # rest fits, which leaves the command after them
+    assert conversation[5] not in window
+    assert conversation[2] not in window
+    assert conversation[3] not in window
+    assert conversation[4] in window
+    assert window[:2] == conversation[:2]
+    assert window[-4:] == conversation[7:]
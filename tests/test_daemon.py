@@ -0,0 +1,191 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import chatbash
+
+
+def start_daemon(socket_path):
+    daemon = subprocess.Popen(
+        [sys.executable, chatbash.__file__, "--daemon"],
+        env=dict(os.environ, CHATBASH_SOCKET=socket_path),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    deadline = time.monotonic() + 10
+    while True:
+        assert daemon.poll() is None, daemon.stderr.read()
+        assert time.monotonic() < deadline, "daemon didn't start"
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            if probe.connect_ex(socket_path) == 0:
+                return daemon
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def socket_path(tmp_path, monkeypatch):
+    directory = tmp_path / "chatbash"
+    directory.mkdir(mode=0o700)
+    path = str(directory / "daemon.sock")
+    monkeypatch.setattr(chatbash, "SOCKET_PATH", path)
+    return path
+
+
+@pytest.fixture
+def listener(socket_path):
+    # Something that accepts connections on the socket and records what it is
+    # sent, but never answers
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    received = []
+
+    def accept():
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return
+            data = connection.recv(65536)
+            if data:
+                received.append(data)
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield received
+    server.close()
+
+
+def test_requests_go_through_the_daemon(fake_api, socket_path):
+    server = fake_api()
+    daemon = start_daemon(socket_path)
+    try:
+        content = chatbash.request_completion_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+        deltas = chatbash.request_completion_stream_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+        streamed = "".join(deltas)
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    assert content == streamed == "```echo list-files```"
+    assert server.request_count == 2
+
+
+def test_a_second_daemon_refuses_to_start(fake_api, socket_path):
+    fake_api()
+    daemon = start_daemon(socket_path)
+    try:
+        second = subprocess.run(
+            [sys.executable, chatbash.__file__, "--daemon"],
+            env=dict(os.environ, CHATBASH_SOCKET=socket_path),
+            capture_output=True,
+            text=True,
+            timeout=30,
+        )
+        assert second.returncode == 1
+        assert "already listening" in second.stderr
+        # and the first one is still there
+        assert chatbash.request_completion_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_a_stale_socket_is_replaced(fake_api, socket_path):
+    fake_api()
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+
+    daemon = start_daemon(socket_path)
+    try:
+        assert chatbash.request_completion_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_nothing_is_sent_to_a_socket_in_a_shared_directory(listener, socket_path):
+    os.chmod(os.path.dirname(socket_path), 0o777)
+
+    reply = chatbash.request_completion_from_daemon(
+        chatbash.command_request("list files"), "sk-test"
+    )
+
+    assert reply is None
+    time.sleep(0.1)
+    assert listener == []
+
+
+def test_nothing_is_sent_to_another_users_daemon(listener, monkeypatch):
+    monkeypatch.setattr(chatbash, "peer_uid", lambda client: os.getuid() + 1)
+
+    reply = chatbash.request_completion_stream_from_daemon(
+        chatbash.command_request("list files"), "sk-test"
+    )
+
+    assert reply is None
+    time.sleep(0.1)
+    assert listener == []
+
+
+def test_a_daemon_that_stops_answering_is_skipped(listener, monkeypatch):
+    monkeypatch.setattr(chatbash, "DAEMON_TIMEOUT", 0.2)
+
+    assert (
+        chatbash.request_completion_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+        is None
+    )
+    assert (
+        chatbash.request_completion_stream_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+        is None
+    )
+
+
+def test_a_client_hanging_up_mid_stream_is_not_an_error(fake_api, socket_path):
+    server = fake_api(latency_ms=200)
+    daemon = start_daemon(socket_path)
+    try:
+        # what --stream does once the command has arrived: stop reading and
+        # close the connection while the reply is still coming
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            request = {
+                "messages": chatbash.command_request("list files"),
+                "api_key": "sk-test",
+                "stream": True,
+            }
+            client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        deadline = time.monotonic() + 10
+        while server.request_count == 0:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        time.sleep(0.5)
+
+        # and the daemon carries on serving
+        assert chatbash.request_completion_from_daemon(
+            chatbash.command_request("list files"), "sk-test"
+        )
+    finally:
+        daemon.terminate()
+        _, errors = daemon.communicate()
+
+    assert "Traceback" not in errors
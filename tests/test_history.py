@@ -0,0 +1,150 @@
+import functools
+import random
+
+import pytest
+
+import chatbash
+
+
+@pytest.fixture
+def history(tmp_path):
+    return chatbash.CommandHistory(str(tmp_path / "history.sqlite"))
+
+
+@functools.lru_cache(maxsize=None)
+def trigrams(prompt):
+    return chatbash.trigrams(prompt)
+
+
+def similarity(prompt, past_prompt):
+    grams, past_grams = trigrams(prompt), trigrams(past_prompt)
+    shared = len(grams & past_grams)
+    return shared / (len(grams) + len(past_grams) - shared)
+
+
+def brute_force_search(history, prompt, limit, threshold):
+    # What search() approximates: every run ranked by the similarity of its
+    # prompt, then by recency, one per command.
+    scored = []
+    for entry, past_prompt, command, timestamp in history.db.execute(
+        "SELECT id, prompt, command, time FROM history"
+    ):
+        if not trigrams(prompt) or not trigrams(past_prompt):
+            continue
+        score = similarity(prompt, past_prompt)
+        if score >= threshold:
+            scored.append((score, entry, past_prompt, command, timestamp))
+    scored.sort(reverse=True)
+    matches = {}
+    for score, _, past_prompt, command, timestamp in scored:
+        matches.setdefault(command, (score, past_prompt, command, timestamp))
+        if len(matches) == limit:
+            break
+    return list(matches.values())
+
+
+def test_trigrams():
+    assert chatbash.trigrams("ls") == {"  l", " ls", "ls "}
+    assert chatbash.trigrams("List  FILES!") == chatbash.trigrams("list files")
+    assert " fi" in chatbash.trigrams("list files")
+    assert chatbash.trigrams("") == set()
+    assert chatbash.trigrams("?! --") == set()
+
+
+def test_exact_repeat_of_an_old_prompt_is_found(history):
+    history.add("show disk usage", "du -sh .")
+    # far more near duplicates than a bucket remembers
+    for n in range(300):
+        history.add(
+            f"show disk usage of project {n} sorted by size",
+            f"du -sh project{n} | sort -h",
+        )
+
+    matches = history.search("show disk usage", threshold=0.5)
+
+    assert matches[0][:3] == (1.0, "show disk usage", "du -sh .")
+
+
+def test_one_match_per_command_most_recent_first(history):
+    history.add("list files", "ls")
+    history.add("list all files", "ls -a")
+    history.add("list the files", "ls")
+    history.add("list files", "ls -a")
+
+    matches = history.search("list files", limit=5, threshold=0.3)
+
+    assert [(prompt, command) for _, prompt, command, _ in matches] == [
+        ("list files", "ls -a"),
+        ("list files", "ls"),
+    ]
+
+
+def test_no_match(history):
+    history.add("list files", "ls")
+
+    assert history.search("kill the process on port 8080", threshold=0.5) == []
+    assert history.search("", threshold=0.5) == []
+
+
+@pytest.fixture(scope="module")
+def long_history(tmp_path_factory):
+    # Templated prompts with many near duplicates, mixed with random ones
+    history = chatbash.CommandHistory(
+        str(tmp_path_factory.mktemp("history") / "history.sqlite")
+    )
+    rng = random.Random(1)
+    words = "find files larger than kill process on port list show disk usage "
+    words += "delete old logs the in of all compress directory count lines"
+    words = words.split()
+    templates = [
+        "show disk usage of project {n} sorted by size",
+        "find files larger than {n}G in /var/{w}",
+        "kill the process on port {n}",
+        "delete {w} logs older than {n} days",
+        "show disk usage",
+    ]
+    prompts = []
+    for _ in range(1500):
+        if rng.random() < 0.5:
+            template = rng.choice(templates)
+            prompt = template.format(n=rng.randint(1, 60), w=rng.choice(words))
+        else:
+            prompt = " ".join(rng.choice(words) for _ in range(rng.randint(1, 8)))
+        prompts.append(prompt)
+        history.add(prompt, f"command {rng.randint(1, 400)}")
+
+    queries = rng.sample(prompts, 40)
+    queries += [query.replace("e", "a", 1) for query in queries[:20]]
+    queries += ["show disk usage", "kill process on port 8080", "ls", "zzz"]
+    return history, queries
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.7, 0.9])
+def test_matches_are_real_runs_ranked_by_similarity(long_history, threshold):
+    history, queries = long_history
+    last_runs = {}
+    for _, prompt, command, timestamp in history.db.execute(
+        "SELECT id, prompt, command, time FROM history ORDER BY id"
+    ):
+        last_runs[prompt, command] = timestamp
+    for query in queries:
+        for limit in (1, 3, 20):
+            matches = history.search(query, limit, threshold)
+
+            assert len(matches) <= limit
+            assert len({command for _, _, command, _ in matches}) == len(matches)
+            assert [score for score, *_ in matches] == sorted(
+                (score for score, *_ in matches), reverse=True
+            )
+            for score, prompt, command, timestamp in matches:
+                assert score == similarity(query, prompt) >= threshold
+                assert timestamp == last_runs[prompt, command]
+
+
+def test_close_matches_are_as_close_as_brute_force(long_history):
+    # The search can miss weak matches, but not the best of the close ones
+    history, queries = long_history
+    for query in queries:
+        expected = brute_force_search(history, query, 1, 0.2)
+        if expected and expected[0][0] >= 0.7:
+            assert history.search(query, 1, 0.2)[0][0] == expected[0][0], query
@@ -0,0 +1,229 @@
+import pytest
+
+import chatbash
+
+LS_PAGE = r""".TH LS 1
+.SH NAME
+ls \- list directory contents
+.SH OPTIONS
+.TP
+\fB\-a\fR, \fB\-\-all\fR
+do not ignore entries starting with .
+.TP
+\fB\-l\fR
+use a long listing format
+"""
+
+TAR_PAGE = r""".TH TAR 1
+.SH NAME
+tar \- an archiving utility
+.SH OPTIONS
+.IP "\fB\-x\fR, \fB\-\-extract\fR"
+Extract files from an archive. Arguments are optional.
+.IP "\fB\-z\fR, \fB\-\-gzip\fR"
+Filter the archive through
+.BR gzip (1).
+.TP
+.B \-v
+.TQ
+.B \-\-verbose
+Verbosely list files processed.
+.TP
+\fB\-f\fR, \fB\-\-file\fR=\fIARCHIVE\fR
+Use archive file or device \fIARCHIVE\fR.
+.SH SEE ALSO
+.TP
+\-this is not an option
+"""
+
+# the .PP/.RS layout DocBook emits, as in git's pages
+GIT_COMMIT_PAGE = r""".TH "GIT\-COMMIT" "1"
+.SH "NAME"
+git-commit \- Record changes to the repository
+.SH "OPTIONS"
+.PP
+\-a, \-\-all
+.RS 4
+Tell the command to automatically stage files that have been modified and
+deleted\&.
+.RE
+.PP
+\-m <msg>, \-\-message=<msg>
+.RS 4
+Use the given <msg> as the commit message\&.
+.RE
+"""
+
+GIT_PAGE = r""".TH "GIT" "1"
+.SH "NAME"
+git \- the stupid content tracker
+"""
+
+SUDO_PAGE = r""".TH SUDO 8
+.SH NAME
+sudo \- execute a command as another user
+.SH OPTIONS
+.TP
+\fB\-E\fR, \fB\-\-preserve\-env\fR
+Indicates to the security policy that the user wishes to preserve their
+existing environment variables.
+"""
+
+FIND_PAGE = r""".TH FIND 1
+.SH NAME
+find \- search for files in a directory hierarchy
+.SH EXPRESSION
+.IP "\-size \fIn\fR[cwbkMG]"
+File uses less than, more than or exactly \fIn\fP units of space.
+.IP "\-exec \fIcommand\fR ;"
+Execute \fIcommand\fR; true if 0 status is returned.
+.IP "\-print"
+True; print the full file name on the standard output.
+"""
+
+PAGES = {
+    "ls": LS_PAGE,
+    "tar": TAR_PAGE,
+    "git": GIT_PAGE,
+    "git-commit": GIT_COMMIT_PAGE,
+    "sudo": SUDO_PAGE,
+    "find": FIND_PAGE,
+}
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / "man.sqlite")
+    index = chatbash.ManIndex(path)
+    with index.db:
+        for name, page in PAGES.items():
+            index.add_page(name, *chatbash.parse_man_page(page))
+    return path
+
+
+def test_tagged_paragraphs():
+    summary, options = chatbash.parse_man_page(LS_PAGE)
+    assert summary == "list directory contents"
+    assert options == {
+        "-a": "do not ignore entries starting with .",
+        "--all": "do not ignore entries starting with .",
+        "-l": "use a long listing format",
+    }
+
+
+def test_indented_paragraphs_and_continued_tags():
+    summary, options = chatbash.parse_man_page(TAR_PAGE)
+    assert summary == "an archiving utility"
+    # only the first sentence is kept
+    assert options["-x"] == options["--extract"] == "Extract files from an archive."
+    assert options["--gzip"] == "Filter the archive through gzip(1)."
+    assert options["-v"] == options["--verbose"] == "Verbosely list files processed."
+    assert options["--file"] == "Use archive file or device ARCHIVE."
+    # a tag in another section that only looks like an option
+    assert "-this" not in options
+
+
+def test_docbook_layout():
+    summary, options = chatbash.parse_man_page(GIT_COMMIT_PAGE)
+    assert summary == "Record changes to the repository"
+    assert options["-a"].startswith("Tell the command to automatically stage")
+    assert options["-a"].endswith("modified and deleted.")
+    assert options["-m"] == options["--message"]
+
+
+def test_roff_escapes():
+    assert chatbash.clean_roff(r"\fB\-\-all\fR") == "--all"
+    assert chatbash.clean_roff(r"it\(aqs a \fIback\\slash\fP") == "it's a back\\slash"
+    assert chatbash.clean_roff(r"\s-1SMALL\s0 \e \*(lq") == "SMALL \\ "
+
+
+@pytest.mark.parametrize(
+    "command, segments",
+    [
+        ("ls -la", [["ls", "-la"]]),
+        (
+            "ps aux | grep -v grep | wc -l",
+            [["ps", "aux"], ["grep", "-v", "grep"], ["wc", "-l"]],
+        ),
+        ("make -j4 > build.log 2>&1", [["make", "-j4"]]),
+        ("sort < in.txt >> out.txt", [["sort"]]),
+        ("head -n 2 > out.txt", [["head", "-n", "2"]]),
+        ("LANG=C FOO='a b' sort -u", [["sort", "-u"]]),
+        ("(cd /tmp && ls) || echo no", [["cd", "/tmp"], ["ls"], ["echo", "no"]]),
+        ("cat a; cat b & wait", [["cat", "a"], ["cat", "b"], ["wait"]]),
+        (
+            r"find . -name '*.tmp' -exec rm {} \; -print",
+            [["find", ".", "-name", "*.tmp", "-exec", "rm", "{}", ";", "-print"]],
+        ),
+        (
+            "find . -exec rm {} ';' ; ls",
+            [["find", ".", "-exec", "rm", "{}", ";"], ["ls"]],
+        ),
+        ("echo 'a; b' \"c | d\"", [["echo", "a; b", "c | d"]]),
+        (
+            "sudo -E nohup find / -size +1G",
+            [["sudo", "-E"], ["nohup"], ["find", "/", "-size", "+1G"]],
+        ),
+        ("time FOO=1 make", [["time"], ["make"]]),
+        ("echo 'unbalanced", [["echo", "'unbalanced"]]),
+    ],
+)
+def test_split_command_line(command, segments):
+    assert list(chatbash.split_command_line(command)) == segments
+
+
+def test_describe_flag(index_path):
+    index = chatbash.ManIndex(index_path)
+    assert index.describe_flag("tar", "--file=foo.tgz") == [
+        ("--file", "Use archive file or device ARCHIVE.")
+    ]
+    assert [flag for flag, _ in index.describe_flag("tar", "-xzvf")] == [
+        "-x",
+        "-z",
+        "-v",
+        "-f",
+    ]
+    assert index.describe_flag("tar", "-xq") is None
+    assert index.describe_flag("tar", "-q") is None
+    assert index.describe_flag("tar", "--quiet") is None
+    assert index.describe_flag("ls", "-x") is None
+
+
+def printed(capsys):
+    # rich wraps long lines to the terminal's width
+    return " ".join(capsys.readouterr().out.split())
+
+
+def test_explain_offline(index_path, capsys):
+    covered = chatbash.explain_offline(
+        "git commit -a -m 'fix' && tar -xzf site.tgz | ls -la", index_path
+    )
+
+    assert covered
+    out = printed(capsys)
+    assert out.startswith("git-commit: Record changes to the repository -a Tell")
+    assert "tar: an archiving utility -x Extract files from an archive. -z" in out
+    assert out.endswith(
+        "ls: list directory contents -l use a long listing format "
+        "-a do not ignore entries starting with ."
+    )
+
+
+def test_wrappers_are_explained(index_path, capsys):
+    covered = chatbash.explain_offline("sudo -E find / -size +1G", index_path)
+
+    assert covered
+    out = printed(capsys)
+    assert out.startswith(
+        "sudo: execute a command as another user " "-E Indicates to the security policy"
+    )
+    assert "find: search for files in a directory hierarchy -size" in out
+
+
+def test_unknown_parts_are_not_covered(index_path, capsys):
+    # nohup has no page in this index
+    assert not chatbash.explain_offline("nohup ls -la", index_path)
+    assert "nohup: not in the man pages" in printed(capsys)
+    assert not chatbash.explain_offline("ls --color", index_path)
+    assert "--color not in the man page" in printed(capsys)
+    assert not chatbash.explain_offline("ls", str(index_path) + ".missing")
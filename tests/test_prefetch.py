@@ -0,0 +1,94 @@
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import chatbash
+
+
+def test_stale_speculation_is_dropped_without_waiting(fake_api):
+    server = fake_api(latency_ms=2000)
+    chat = chatbash.ChatHandler(use_cache=False, use_daemon=False, prefetch_verify=True)
+    chat.conversation.extend(chatbash.command_request("list files"))
+    chat.conversation.append({"role": "assistant", "content": "ls"})
+    chat.prefetch("ls")
+    speculations = dict(chat.prefetcher.speculations)
+
+    # an explanation in between makes the verify speculation stale
+    chat.conversation.append(chatbash.explanation_request("ls"))
+    chat.conversation.append({"role": "assistant", "content": "lists files"})
+    chat.conversation.append(chatbash.verify_request("ls"))
+
+    assert chat.take_prefetched("verify") is None
+    # dropped before the server answered it
+    assert not speculations["verify"].done.is_set()
+
+    # let both speculations finish, so they can't retry into a later test
+    for speculation in speculations.values():
+        assert speculation.done.wait(30)
+    assert server.request_count == 2
+
+
+def test_matching_speculation_is_used(fake_api):
+    server = fake_api()
+    chat = chatbash.ChatHandler(use_cache=False, use_daemon=False, prefetch=True)
+    chat.conversation.extend(chatbash.command_request("list files"))
+    chat.conversation.append({"role": "assistant", "content": "ls"})
+    chat.prefetch("ls")
+    chat.conversation.append(chatbash.explanation_request("ls"))
+
+    assert "ls" in chat.take_prefetched("explain")
+    assert server.request_count == 1
+
+
+def test_daemon_serves_requests_concurrently(fake_api, tmp_path, monkeypatch):
+    server = fake_api(latency_ms=2000)
+    socket_path = str(tmp_path / "daemon.sock")
+    env = dict(os.environ, CHATBASH_SOCKET=socket_path)
+    daemon = subprocess.Popen(
+        [sys.executable, chatbash.__file__, "--daemon"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_path):
+            assert time.monotonic() < deadline, "daemon didn't start"
+            time.sleep(0.05)
+        monkeypatch.setattr(chatbash, "SOCKET_PATH", socket_path)
+
+        # a prefetched explanation and verification, then the real request
+        conversations = [chatbash.command_request(f"list files {i}") for i in range(3)]
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            replies = list(
+                executor.map(
+                    lambda conversation: chatbash.request_completion_from_daemon(
+                        conversation, "sk-test"
+                    ),
+                    conversations,
+                )
+            )
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    assert replies == [f"```echo list-files-{i}```" for i in range(3)]
+    assert server.request_count == 3
+    # the server takes long enough that one at a time would never overlap
+    assert server.max_in_flight == 3
+
+
+def test_speculative_requests_dont_print_the_context(fake_api, capsys):
+    fake_api()
+    chat = chatbash.ChatHandler(
+        use_cache=False, use_daemon=False, prefetch=True, show_context=True
+    )
+    chat.conversation.extend(chatbash.command_request("list files"))
+    chat.conversation.append({"role": "assistant", "content": "ls"})
+    chat.prefetch("ls")
+    assert chat.prefetcher.speculations["explain"].done.wait(30)
+    assert "Sending" not in capsys.readouterr().out
+
+    chat.chat_gpt(chat.conversation)
+    assert "Sending 3 of 3 messages" in capsys.readouterr().out
@@ -0,0 +1,20 @@
+import json
+
+import chatbash
+
+
+def test_chat_gpt_phases_record_the_request_size(fake_api, monkeypatch, tmp_path):
+    fake_api()
+    profiler = chatbash.Profiler(str(tmp_path / "profile.json"))
+    monkeypatch.setattr(chatbash, "profiler", profiler)
+    chat = chatbash.ChatHandler(use_cache=False, use_daemon=False)
+    conversation = chatbash.command_request("list files")
+
+    chat.chat_gpt(conversation)
+    chat.stream_gpt(conversation).render()
+
+    phases = {phase["name"]: phase for phase in profiler.phases}
+    for name in ["chat_gpt", "stream_gpt first token"]:
+        assert phases[name]["messages"] == 2
+        assert phases[name]["request_bytes"] == len(json.dumps(conversation))
+    assert phases["chat_gpt"]["cached"] is False
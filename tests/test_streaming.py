@@ -0,0 +1,64 @@
+import random
+
+import pytest
+
+import chatbash
+
+
+def random_reply(rng):
+    # mostly backticks, so fences, snippets and near misses like ```` or a
+    # fence with nothing in it all turn up often
+    length = rng.randint(0, 30)
+    return "".join(rng.choice("````` ab\n") for _ in range(length))
+
+
+def random_chunks(rng, text):
+    cuts = sorted(rng.sample(range(1, len(text)), rng.randint(0, len(text) - 1)))
+    return [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+
+def extract(chunks):
+    # What render_until_command does: the first chunk after which feed()
+    # reports a command, and that command, or finish() after the last chunk
+    extractor = chatbash.CodeBlockExtractor()
+    for position, chunk in enumerate(chunks):
+        command = extractor.feed(chunk)
+        if command is not None:
+            return position, command
+    return None, extractor.finish()
+
+
+def test_fenced_block_is_found_once_it_closes():
+    chunks = ["Here you go: ``", "`ls -", "la`", "``", " and more ```x```"]
+    assert extract(chunks) == (3, "ls -la")
+
+
+def test_inline_snippet_waits_for_the_whole_reply():
+    chunks = ["Run `ls", "` or, better, ", "```ls -la``", "`"]
+    assert extract(chunks) == (3, "ls -la")
+    assert extract(["Run `ls` to list files"]) == (None, "ls")
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_extractor_agrees_with_find_code_block(seed):
+    rng = random.Random(seed)
+    for _ in range(5000):
+        text = random_reply(rng)
+        if not text:
+            continue
+        chunks = random_chunks(rng, text)
+        position, command = extract(chunks)
+
+        # a command is reported from the first chunk that completes a
+        # fenced block, and it is the one find_code_block picks
+        assert command == chatbash.find_code_block(text), chunks
+        prefixes = ["".join(chunks[: i + 1]) for i in range(len(chunks))]
+        first_fenced = next(
+            (
+                i
+                for i, prefix in enumerate(prefixes)
+                if chatbash.CODE_BLOCK_PATTERN.search(prefix)
+            ),
+            None,
+        )
+        assert position == first_fenced, chunks